@@ -0,0 +1,140 @@
+"""End-to-end export benchmark against the local Userside stand-in
+
+Every scale runs export_commutation.py in a fresh process and working directory (cold caches),
+and collects wall time, per-stage costs and peak memory from its --report output.
+
+    python benchmarks/bench_export.py --scales 1000,10000 --save results.json
+    python benchmarks/bench_export.py --scales 1000,10000 --baseline results.json
+    python benchmarks/bench_export.py --scales 100000 --latency 0.05 --env USERSIDE_BATCH_SIZE=1000 -- --engine pandas
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_userside import MockUserside
+from synthetic import generate_dataset
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'export_commutation.py')
+
+
+def run_export(url, export_args, env_overrides, warm=False):
+    """Run one export in a temporary directory
+
+    Returns:
+        dict: run report with "wall_seconds" added
+    """
+    env = dict(os.environ, USERSIDE_API_KEY='benchmark', USERSIDE_API_URL=url, **env_overrides)
+    with tempfile.TemporaryDirectory() as workdir:
+        command = [sys.executable, SCRIPT, '--output', 'export', '--report', 'report.json', '--log-level', 'WARNING']
+        command += export_args
+        runs = 2 if warm else 1
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run(command, cwd=workdir, env=env, check=True)
+            wall_seconds = time.perf_counter() - started
+        with open(os.path.join(workdir, 'report.json')) as f:
+            report = json.load(f)
+    report['wall_seconds'] = round(wall_seconds, 3)
+    return report
+
+
+def run_scale(customers, args):
+    dataset = generate_dataset(
+        customers,
+        devices=max(customers // args.customers_per_device, 1),
+        houses=max(customers // args.customers_per_house, 1)
+    )
+    mock = MockUserside(dataset, args.latency, args.failure_rate).start()
+    try:
+        report = run_export(mock.url, args.export_args, args.env, args.warm)
+    finally:
+        mock.stop()
+    report['mock_requests'] = mock.requests
+    return report
+
+
+def print_results(results):
+    stages = sorted({stage for report in results.values() for stage in report['stages']})
+    header = ['customers', 'wall s', 'peak MB', 'rows/s'] + [f"{stage} s" for stage in stages]
+    print(' '.join(f"{column:>12}" for column in header))
+    for scale, report in results.items():
+        peak = report['peak_rss_bytes']
+        row = [
+            scale,
+            report['wall_seconds'],
+            f"{peak / 1024 / 1024:.0f}" if peak is not None else '-',
+            report['rows_per_second'] or '-'
+        ]
+        row += [report['stages'].get(stage, '-') for stage in stages]
+        print(' '.join(f"{value:>12}" for value in row))
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of wall time and peak memory against a saved run
+
+    Returns:
+        list: messages, empty if nothing regressed
+    """
+    regressions = []
+    for scale, report in results.items():
+        previous = baseline.get(scale)
+        if not previous:
+            continue
+        for metric in ('wall_seconds', 'peak_rss_bytes'):
+            old, new = previous.get(metric), report.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{scale} customers: {metric} {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def parse_env(value):
+    key, _, env_value = value.partition('=')
+    if not key or not _:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {value!r}")
+    return key, env_value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark export_commutation.py against a local Userside stand-in')
+    parser.add_argument('--scales', default='1000,10000', help='comma separated customer counts, e.g. 1000,10000,100000,1000000')
+    parser.add_argument('--customers-per-device', type=int, default=20)
+    parser.add_argument('--customers-per-house', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of API requests failing with 429/503')
+    parser.add_argument('--warm', action='store_true', help='measure a second run that reuses the caches of the first')
+    parser.add_argument('--env', type=parse_env, action='append', default=[], help='extra KEY=VALUE for the export environment')
+    parser.add_argument('--save', help='write results to a JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown/growth against the baseline')
+    parser.add_argument('export_args', nargs=argparse.REMAINDER, help='arguments after -- are passed to the export')
+    args = parser.parse_args()
+    args.env = dict(args.env)
+    if args.export_args[:1] == ['--']:
+        args.export_args = args.export_args[1:]
+
+    results = {}
+    for scale in args.scales.split(','):
+        customers = int(scale)
+        print(f"Running {customers} customers...", file=sys.stderr)
+        results[str(customers)] = run_scale(customers, args)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Startup time check for export_commutation.py
+
+Cron runs and lookups pay the interpreter and import cost on every start, so heavy optional
+dependencies (pandas, openpyxl, pyarrow, httpx, ijson) must only be imported by the code that
+uses them. Every measurement runs in a fresh process and the best of --runs is reported.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --budget 0.3 --runs 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(PACKAGE_DIR, 'export_commutation.py')
+LAZY_MODULES = ('pandas', 'openpyxl', 'pyarrow', 'httpx', 'ijson')
+
+CHECK_MODULES = f"""
+import json, sys
+import export_commutation
+print(json.dumps(sorted(name for name in {LAZY_MODULES!r} if name in sys.modules)))
+"""
+
+
+def best_time(command, runs):
+    """Run a command in fresh processes
+
+    Returns:
+        float: fastest wall time in seconds
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=PACKAGE_DIR, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check export_commutation.py startup time and lazy imports')
+    parser.add_argument('--runs', type=int, default=5, help='processes per measurement, the fastest counts')
+    parser.add_argument('--budget', type=float, default=0.5, help='maximum seconds for import and --help')
+    args = parser.parse_args()
+
+    results = {
+        'interpreter': best_time([sys.executable, '-c', 'pass'], args.runs),
+        'import': best_time([sys.executable, '-c', 'import export_commutation'], args.runs),
+        'help': best_time([sys.executable, SCRIPT, '--help'], args.runs),
+    }
+    for name, seconds in results.items():
+        print(f"{name:<12} {seconds:8.3f}s")
+
+    output = subprocess.run(
+        [sys.executable, '-c', CHECK_MODULES], cwd=PACKAGE_DIR, check=True, capture_output=True, text=True
+    ).stdout
+    eager = json.loads(output)
+
+    failures = [f"{name} took {results[name]:.3f}s, budget {args.budget}s"
+                for name in ('import', 'help') if results[name] > args.budget]
+    if eager:
+        failures.append(f"imported at startup: {', '.join(eager)}")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
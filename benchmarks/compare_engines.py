@@ -0,0 +1,73 @@
+"""Check that the loop and pandas join engines export the same rows
+
+Both engines run export_commutation.py against the local Userside stand-in with the
+synthetic dataset (switch commutations plus passive ones, some without an interface)
+and their CSV exports are compared line by line.
+
+    python benchmarks/compare_engines.py --customers 10000
+    python benchmarks/compare_engines.py --customers 10000 -- --workers 4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from mock_userside import MockUserside
+from synthetic import generate_dataset
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'export_commutation.py')
+ENGINES = ('loop', 'pandas')
+
+
+def export_lines(url, engine, export_args):
+    """Run one CSV export in a temporary directory
+
+    Returns:
+        list: lines of the exported file
+    """
+    env = dict(os.environ, USERSIDE_API_KEY='benchmark', USERSIDE_API_URL=url)
+    with tempfile.TemporaryDirectory() as workdir:
+        command = [
+            sys.executable, SCRIPT, 'export', '--format', 'csv', '--output', 'export.csv',
+            '--engine', engine, '--log-level', 'ERROR', *export_args
+        ]
+        subprocess.run(command, cwd=workdir, env=env, check=True)
+        with open(os.path.join(workdir, 'export.csv'), encoding='utf-8') as f:
+            return f.read().splitlines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the output of the loop and pandas engines')
+    parser.add_argument('--customers', type=int, default=5000)
+    parser.add_argument('--customers-per-device', type=int, default=20)
+    parser.add_argument('--customers-per-house', type=int, default=5)
+    parser.add_argument('export_args', nargs=argparse.REMAINDER, help='arguments after -- are passed to both exports')
+    args = parser.parse_args()
+    export_args = args.export_args[1:] if args.export_args[:1] == ['--'] else args.export_args
+
+    dataset = generate_dataset(
+        args.customers,
+        devices=max(args.customers // args.customers_per_device, 1),
+        houses=max(args.customers // args.customers_per_house, 1)
+    )
+    mock = MockUserside(dataset).start()
+    try:
+        outputs = {engine: export_lines(mock.url, engine, export_args) for engine in ENGINES}
+    finally:
+        mock.stop()
+
+    loop_lines, pandas_lines = (outputs[engine] for engine in ENGINES)
+    print(f"loop: {len(loop_lines) - 1} rows, pandas: {len(pandas_lines) - 1} rows")
+    for number, (loop_line, pandas_line) in enumerate(zip(loop_lines, pandas_lines), 1):
+        if loop_line != pandas_line:
+            print(f"FAIL line {number} differs:\n  loop:   {loop_line}\n  pandas: {pandas_line}")
+            sys.exit(1)
+    if len(loop_lines) != len(pandas_lines):
+        print("FAIL row counts differ")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
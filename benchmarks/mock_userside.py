@@ -0,0 +1,175 @@
+"""Local stand-in for the Userside API endpoints used by export_commutation.py
+
+Serves commutation/get_data, customer/get_data, customer/get_customers_id, address/get_house
+and device/get_data
+from a synthetic dataset, with configurable latency and failure injection.
+
+Run standalone:
+    python benchmarks/mock_userside.py --customers 10000 --devices 500 --houses 2000 --port 8765
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import generate_dataset
+
+
+class MockUserside:
+    """Mock Userside API server
+
+    Args:
+        dataset: generate_dataset result
+        latency: seconds added to every response
+        failure_rate: share of requests answered with 503 or 429
+        port: TCP port, 0 picks a free one
+    """
+
+    def __init__(self, dataset, latency=0.0, failure_rate=0.0, port=0, seed=1):
+        self.dataset = dataset
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, call):
+        with self._lock:
+            self.requests[call] = self.requests.get(call, 0) + 1
+
+    def _should_fail(self):
+        with self._lock:
+            return self.rng.random() < self.failure_rate
+
+    def handle(self, params):
+        """Route a request
+
+        Returns:
+            dict: response payload
+        """
+        call = f"{params.get('cat')}/{params.get('action')}"
+        self._count(call)
+
+        if call == 'commutation/get_data':
+            data = self.dataset['commutation']
+            if params.get('object_type') != 'customer':
+                data = {}
+            if params.get('object_id'):
+                data = _select(data, params['object_id'])
+        elif call == 'customer/get_customers_id':
+            building_ids = set(params['house_id'].split(',')) if params.get('house_id') else None
+            group_ids = set(params['group_id'].split(',')) if params.get('group_id') else None
+            data = [
+                customer_id for customer_id, customer in self.dataset['customers'].items()
+                if (building_ids is None or str(customer['address'][0]['house_id']) in building_ids)
+                and (group_ids is None or group_ids & set(customer['group']))
+            ]
+            return {'Result': 'OK', 'data': ','.join(data)}
+        elif call == 'customer/get_data':
+            data = _select(self.dataset['customers'], params.get('customer_id', ''))
+        elif call == 'address/get_house':
+            building_ids = set(params.get('building_id', '').split(','))
+            data = {
+                house_id: house for house_id, house in self.dataset['houses'].items()
+                if str(house['building_id']) in building_ids
+            }
+        elif call == 'device/get_data':
+            data = self.dataset['devices']
+            if params.get('object_id'):
+                data = _select(data, params['object_id'])
+        else:
+            return {'Result': 'ERROR', 'ErrorText': f"Unknown method {call}"}
+        # PHP encodes empty arrays as lists
+        return {'Result': 'OK', 'data': data or []}
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _params(self):
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    params.update({key: values[0] for key, values in parse_qs(body).items()})
+                return params
+
+            def _respond(self):
+                params = self._params()
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if mock._should_fail():
+                    status = mock.rng.choice((429, 503))
+                    self.send_response(status)
+                    self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = json.dumps(mock.handle(params)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+        return Handler
+
+
+def _select(records, ids):
+    """Records with the given comma separated ids"""
+    return {record_id: records[record_id] for record_id in str(ids).split(',') if record_id in records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic Userside API')
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--houses', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests failing with 429/503')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.customers, args.devices, args.houses)
+    mock = MockUserside(dataset, args.latency, args.failure_rate, args.port)
+    print(f"Serving synthetic Userside API at {mock.url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Synthetic Userside data with the payload shapes documented in UsersideAPI docstrings"""
+import random
+
+# Device fields besides the ones used by the export, to keep records as heavy as real ones
+DEVICE_PADDING_FIELDS = (
+    'devtyper', 'skladcode', 'opis', 'port', 'uzelcode', 'usercode', 'lastact', 'dateadd',
+    'com_public', 'com_private', 'com_login', 'com_pass', 'is_peleng', 'valuememo', 'snmpver',
+    'fdpver', 'x1', 'y1', 'upport', 'onsms', 'issmssend', 'hash_port2', 'onmail', 'ismailsend',
+    'proshivka', 'proshivka_date', 'cablelen', 'basecode', '_param', 'rotation', 'ipabon',
+    'snmp_dontask', 'log_status', 'dnport', 'datepeleng', 'ipport', 'profile', 'azimut',
+    'sectcoord', 'colcol', 'flag_custom_coord', 'level_max', 'level_min', 'latitude', 'longitude',
+    '_ip', '_mac', 'snmp_port', 'date_cabletest', 'date_iferr', 'activity_update_by',
+    'sfp_att_list', 'custom_iface_list', 'options', 'snmp_v3_security_name', 'snmp_v3_sec_level',
+    'snmp_v3_auth_protocol', 'snmp_v3_auth_passphrase', 'snmp_v3_priv_protocol',
+    'snmp_v3_priv_passphrase', 'telnet_enable_password'
+)
+
+
+def make_device(device_id, ports, rng):
+    device = {
+        'code': device_id,
+        'location': f"BILL{device_id:07d}",
+        'nazv': rng.choice(('D-Link DES-3200-28', 'Cambium ePMP Force 190 5Ghz', 'SNR-S2985G-24T')),
+        'hostname': f"sw-{device_id}",
+        'hash_port2': 'YToyOntpOjE7YTo0OntzOjc6ImlmSW5kZXgiO2k6MTtzOjY6ImlmVHlwZSI7aTo2O30=',
+    }
+    for field in DEVICE_PADDING_FIELDS:
+        device.setdefault(field, '')
+    # Userside duplicates every field in upper case
+    device.update({field.upper(): value for field, value in list(device.items())})
+    device.update({
+        'id': device_id,
+        'ID': device_id,
+        'type_id': 4,
+        'name': device['nazv'],
+        'host': f"10.{device_id // 65536 % 256}.{device_id // 256 % 256}.{device_id % 256}",
+        'node_id': device_id % 50,
+        'interfaces': ports,
+        'ifaces': {
+            str(port): {'ifIndex': port, 'ifType': 6, 'ifName': f"Ethernet1/0/{port}", 'ifNumber': port}
+            for port in range(1, ports + 1)
+        },
+        'snmp_community_ro': 'public',
+        'telnet_login': 'admin',
+        'telnet_pass': 'admin'
+    })
+    return device
+
+
+def generate_dataset(customers, devices, houses, ports=24, seed=1):
+    """Generate N customers connected to M switches, living in K houses
+
+    Returns:
+        dict: {"commutation": {...}, "customers": {...}, "houses": {...}, "devices": {...}},
+        each in the format of the `data` field of the corresponding Userside API response
+    """
+    rng = random.Random(seed)
+    # Separate generator for the passive commutations, the rest of the dataset stays as it was
+    passive_rng = random.Random(seed + 1)
+    device_records = {str(device_id): make_device(device_id, ports, rng) for device_id in range(1, devices + 1)}
+
+    house_records = {}
+    for building_id in range(1, houses + 1):
+        house_id = 100000 + building_id
+        house_records[str(house_id)] = {
+            'id': house_id,
+            'name': str(building_id % 120 + 1),
+            'parent_ids': [18621, 18622, 13267, 13353],
+            'parent_id': 13353,
+            'building_id': building_id,
+            'type_id': 1,
+            'floor': 0,
+            'entrance': 0,
+            'apart': 0,
+            'full_name': f"Lemesos, Lemesos Municipality, Street {building_id // 120 + 1}, {building_id % 120 + 1}",
+            'comment': '',
+            'coordinates': [],
+            'exit_comment': '',
+            'task_comment': '',
+            'additional_data': []
+        }
+
+    customer_records = {}
+    commutation = {}
+    for customer_id in range(1, customers + 1):
+        agreement = f"BILL{customer_id:07d}"
+        customer_records[str(customer_id)] = {
+            'id': customer_id,
+            'login': agreement,
+            'full_name': f"Customer {customer_id}",
+            'flag_corporate': 0,
+            'balance': '0',
+            'state_id': 0,
+            'agreement': [{'number': agreement, 'date': '2023-03-09 15:47:54'}],
+            'traffic': {'month': {'up': 0, 'down': 0}},
+            'date_create': '2023-03-09 16:03:28',
+            'is_disable': 0,
+            'address': [{
+                'type': 'connect',
+                'house_id': rng.randint(1, houses),
+                'apartment': {'number': str(rng.randint(1, 200)) if rng.random() < 0.9 else ''}
+            }],
+            'is_in_billing': 1,
+            'billing_id': str(customer_id),
+            'group': {str(customer_id % 20 + 1): {'id': customer_id % 20 + 1}},
+            'tariff': {'current': [{'id': '1214'}]},
+            'account_number': f"1{customer_id:07d}",
+            'phone': [{'number': '+xxxxxxxxxx', 'flag_main': 1}],
+            'comment2': ''
+        }
+        commutation[str(customer_id)] = [{
+            'object_type': 'switch',
+            'object_id': rng.randint(1, devices),
+            'direction': 0,
+            'interface': rng.randint(1, ports),
+            'comment': '',
+            'connect_id': 10000000 + customer_id
+        }]
+        # Some customers also go through a cross box, splitter or fiber, often without a port
+        if passive_rng.random() < 0.1:
+            passive = {
+                'object_type': passive_rng.choice(('cross', 'splitter', 'fiber')),
+                'object_id': passive_rng.randint(1, devices),
+                'direction': 1,
+                'comment': '',
+                'connect_id': 20000000 + customer_id
+            }
+            if passive_rng.random() < 0.5:
+                passive['interface'] = passive_rng.randint(1, ports)
+            commutation[str(customer_id)].append(passive)
+
+    return {
+        'commutation': commutation,
+        'customers': customer_records,
+        'houses': house_records,
+        'devices': device_records
+    }
@@ -1,27 +1,639 @@
+import argparse
+import array
+import asyncio
+import bisect
+import csv
+import hashlib
+import importlib
 import json
+import logging
+import mmap
 import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 from dotenv import load_dotenv
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger('export_commutation')
+
+# HTTP statuses retried with exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DEVICE_CACHE_FILE = 'devices_cache.sqlite'
+# Bump when the cache schema or projected fields change, old caches are rebuilt
+DEVICE_CACHE_VERSION = 3
+# device/get_data object_type used to download all devices of a commutation object type,
+# commutation object types not listed here are downloaded with the same name
+DEVICE_FETCH_TYPES = {'switch': 'all'}
+DEVICE_STORE_VERSION = 1
+# Decoded device records kept per resolver, see DeviceResolver
+DEVICE_LOOKUP_CACHE_SIZE = 65536
+# Legacy cache with raw get_all_devices_data response, imported once if present
+LEGACY_DEVICE_CACHE_FILE = 'devices_data.json'
+# Completed fetch stages and chunks of the current run, see Checkpoint
+WORK_DIR = 'export_work'
+# Marks a work directory as created by Checkpoint, others are never cleared
+CHECKPOINT_MARKER = '.checkpoint'
+# Customers and houses cache, see RecordCache
+RECORD_CACHE_FILE = 'userside_cache.sqlite'
+RECORD_CACHE_VERSION = 1
+# Device fields used by the export, everything else is dropped before caching
+DEVICE_FIELDS = ('location', 'hostname', 'host', 'nazv')
+# Columns of the exported file, in order
+EXPORT_COLUMNS = (
+    'customer_agreement', 'customer_name', 'customer_address', 'device_type',
+    'location', 'hostname', 'ip', 'name', 'iface_data'
+)
+# Columns of a --since-last export, connect_id keys the rows for consumers applying the changes
+DIFF_COLUMNS = ('change_type', 'connect_id', *EXPORT_COLUMNS)
+# Columns of the shard files merged into the export, see export_shards
+SHARD_COLUMNS = ('connect_id', *EXPORT_COLUMNS)
+
+def optional_import(name):
+    """Import an optional or slow to import dependency on first use
+
+    pandas, openpyxl, pyarrow, httpx and ijson are only needed by some engines, sinks
+    and clients, so they are not imported at startup.
+
+    Returns:
+        module, or None if it is not installed
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
 def list_to_string(lst):
     """Convert list to comma-separated string"""
     return ','.join(str(x) for x in lst)
 
-class UsersideAPI:
+def chunk_list(lst, size):
+    """Split list into chunks of at most `size` elements"""
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, None where unavailable"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+class RunStats:
+    """Timings, counters and memory usage of an export run
+
+    Shared by UsersideAPI, the fetch stages and export_rows, safe to use from worker threads.
+    """
+
     def __init__(self):
+        self.started_at = time.time()
+        self.stages = {}
+        self.api_calls = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the time spent in a block as stage `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_api_call(self, call, seconds, downloaded=0, decode_seconds=0.0, failed=False):
+        """Record one Userside API request
+
+        Args:
+            call: API method, e.g. "customer/get_data"
+            seconds: request time including download and decoding
+            downloaded: response body size in bytes
+            decode_seconds: JSON decoding time, 0 when decoded while streaming
+            failed: whether the request failed
+        """
+        with self._lock:
+            stats = self.api_calls.setdefault(call, {
+                'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0, 'decode_seconds': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += downloaded
+            stats['decode_seconds'] += decode_seconds
+
+    def report(self):
+        """Run report as a JSON serializable dict"""
+        with self._lock:
+            rows = self.counters.get('rows', 0)
+            row_seconds = self.stages.get('join', 0.0) + self.stages.get('write', 0.0)
+            return {
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'stages': {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+                'api_calls': {
+                    call: {field: round(value, 3) for field, value in stats.items()}
+                    for call, stats in self.api_calls.items()
+                },
+                'bytes_downloaded': sum(stats['bytes'] for stats in self.api_calls.values()),
+                'json_decode_seconds': round(sum(stats['decode_seconds'] for stats in self.api_calls.values()), 3),
+                'counters': dict(self.counters),
+                'rows_per_second': round(rows / row_seconds, 1) if row_seconds else None,
+                'peak_rss_bytes': peak_rss()
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """Write the report in Prometheus text format, e.g. for the node_exporter textfile collector"""
+        report = self.report()
+        lines = [
+            '# TYPE userside_export_duration_seconds gauge',
+            f"userside_export_duration_seconds {report['duration_seconds']}",
+            '# TYPE userside_export_last_run_timestamp_seconds gauge',
+            f"userside_export_last_run_timestamp_seconds {self.started_at:.0f}",
+            '# TYPE userside_export_stage_seconds gauge'
+        ]
+        lines += [f'userside_export_stage_seconds{{stage="{stage}"}} {seconds}' for stage, seconds in report['stages'].items()]
+        for metric, field in (
+            ('api_calls', 'calls'), ('api_errors', 'errors'), ('api_seconds', 'seconds'),
+            ('api_bytes', 'bytes'), ('api_json_decode_seconds', 'decode_seconds')
+        ):
+            lines.append(f'# TYPE userside_export_{metric} gauge')
+            lines += [
+                f'userside_export_{metric}{{call="{call}"}} {stats[field]}'
+                for call, stats in report['api_calls'].items()
+            ]
+        lines.append('# TYPE userside_export_count gauge')
+        lines += [f'userside_export_count{{name="{name}"}} {value}' for name, value in report['counters'].items()]
+        if report['rows_per_second'] is not None:
+            lines += ['# TYPE userside_export_rows_per_second gauge', f"userside_export_rows_per_second {report['rows_per_second']}"]
+        if report['peak_rss_bytes'] is not None:
+            lines += ['# TYPE userside_export_peak_rss_bytes gauge', f"userside_export_peak_rss_bytes {report['peak_rss_bytes']}"]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def log_summary(self):
+        report = self.report()
+        logger.info(f"Run finished in {report['duration_seconds']:.1f}s, "
+                    f"downloaded {report['bytes_downloaded'] / 1024 / 1024:.1f} MB, "
+                    f"exported {report['counters'].get('rows', 0)} rows")
+        for stage, seconds in report['stages'].items():
+            logger.info(f"  {stage}: {seconds:.2f}s")
+        for call, stats in report['api_calls'].items():
+            logger.info(f"  {call}: {stats['calls']} calls, {stats['errors']} errors, {stats['seconds']:.2f}s, "
+                        f"{stats['bytes'] / 1024 / 1024:.1f} MB, JSON decode {stats['decode_seconds']:.2f}s")
+        if report['peak_rss_bytes'] is not None:
+            logger.info(f"  peak RSS: {report['peak_rss_bytes'] / 1024 / 1024:.0f} MB")
+
+class Checkpoint:
+    """Work directory keeping the results of completed fetch stages and chunks
+
+    Every stage (commutations, customers, houses, devices) and every fetched chunk is
+    written to `work_dir` as soon as it completes. A run with `resume` loads them instead
+    of fetching again; otherwise the directory is cleared. Chunk ids are sorted before
+    splitting, so a resumed run produces the same chunks and finds them by their ids.
+    Only a missing or empty directory is taken over, and only a directory holding the
+    CHECKPOINT_MARKER file is ever removed. The marker keeps the run parameters, e.g.
+    scope and sync flags, and a run with other parameters refuses to resume.
+    """
+
+    def __init__(self, work_dir=WORK_DIR, resume=False, params=None):
+        self.work_dir = work_dir
+        marker = os.path.join(work_dir, CHECKPOINT_MARKER)
+        if os.path.isdir(work_dir) and os.listdir(work_dir) and not os.path.exists(marker):
+            raise ValueError(f"{work_dir} is not empty and was not created by an export, use a dedicated --work-dir")
+        if resume and os.path.exists(marker):
+            with open(marker) as f:
+                # Markers of older versions are empty
+                saved = json.loads(f.read() or 'null')
+            if saved != params:
+                raise ValueError(
+                    f"{work_dir} holds a run with other parameters ({saved}), "
+                    f"run without --resume to start over with {params}"
+                )
+        else:
+            self.clear()
+        os.makedirs(os.path.join(work_dir, 'chunks'), exist_ok=True)
+        with open(marker, 'w') as f:
+            json.dump(params, f)
+
+    def _path(self, name):
+        return os.path.join(self.work_dir, f"{name}.json")
+
+    def load(self, name):
+        """Saved result of a stage, or None if it did not complete"""
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, name, data):
+        # Write to a temporary file first, an interrupted write must not look completed
+        path = self._path(name)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def run(self, name, func):
+        """Load a completed stage or run it and save its result
+
+        Empty results are not saved, so failed stages are retried on resume.
+        """
+        data = self.load(name)
+        if data is not None:
+            logger.info(f"Resuming: {name} loaded from {self.work_dir}")
+            return data
+        data = func()
+        if data:
+            self.save(name, data)
+        return data
+
+    @staticmethod
+    def _chunk_name(name, ids):
+        digest = hashlib.blake2b(list_to_string(ids).encode(), digest_size=16).hexdigest()
+        return os.path.join('chunks', f"{name.replace(' ', '_')}-{digest}")
+
+    def load_chunk(self, name, ids):
+        return self.load(self._chunk_name(name, ids))
+
+    def save_chunk(self, name, ids, data):
+        self.save(self._chunk_name(name, ids), data)
+
+    def clear(self):
+        if os.path.exists(os.path.join(self.work_dir, CHECKPOINT_MARKER)):
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def checkpointed(checkpoint, name, func):
+    """Checkpoint.run if checkpointing is enabled, else just func()"""
+    return func() if checkpoint is None else checkpoint.run(name, func)
+
+
+class ConcurrencyLimiter:
+    """Requests per second and requests in flight budget for Userside API calls
+
+    The in-flight limit adapts AIMD-style: every fast successful response raises it by
+    1/limit (about one per round of requests) up to `max_in_flight`. An overloaded
+    response (429/5xx or a connection failure) halves it, and a response slower than
+    `latency_target` cuts it by a quarter. Only responses to requests started after the
+    last cut can cut again, so a burst of failures from one round counts once.
+    Shared by the sync threads and the async client of one UsersideAPI.
+    """
+
+    def __init__(self, initial=None, max_in_flight=None, rate=None, latency_target=None):
+        self.max_in_flight = max_in_flight or int(os.getenv('USERSIDE_MAX_IN_FLIGHT', 16))
+        self.limit = float(min(initial or int(os.getenv('USERSIDE_MAX_WORKERS', 4)), self.max_in_flight))
+        # Requests per second, 0 for no limit
+        self.rate = float(os.getenv('USERSIDE_RATE_LIMIT', 0)) if rate is None else rate
+        # Seconds until the response headers arrive, see release
+        self.latency_target = latency_target or float(os.getenv('USERSIDE_LATENCY_TARGET', 5))
+        self.in_flight = 0
+        self._next_start = 0.0
+        self._last_cut = 0.0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self):
+        """Take a slot if one is free
+
+        Returns:
+            float: seconds to wait for the rate limit before sending, or None if no slot is free
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            now = time.monotonic()
+            if not self.rate:
+                return 0.0
+            start = max(now, self._next_start)
+            self._next_start = start + 1 / self.rate
+            return start - now
+
+    def acquire(self):
+        """Wait for a slot and the rate limit
+
+        Returns:
+            float: start time to pass to release
+        """
+        with self._condition:
+            delay = self._try_acquire()
+            while delay is None:
+                self._condition.wait()
+                delay = self._try_acquire()
+        time.sleep(delay)
+        return time.monotonic()
+
+    async def acquire_async(self):
+        """acquire for coroutines, polls instead of blocking the event loop"""
+        delay = self._try_acquire()
+        while delay is None:
+            await asyncio.sleep(0.01)
+            delay = self._try_acquire()
+        await asyncio.sleep(delay)
+        return time.monotonic()
+
+    def release(self, started, latency=None, overloaded=False):
+        """Free a slot and adapt the limit to how the request went
+
+        Args:
+            started: value returned by acquire
+            latency: seconds until the response headers arrived, None if unknown
+            overloaded: whether the server answered 429/5xx or could not be reached
+        """
+        with self._condition:
+            self.in_flight -= 1
+            limit = self.limit
+            slow = latency is not None and latency > self.latency_target
+            if (overloaded or slow) and started >= self._last_cut:
+                self.limit = max(1.0, self.limit * (0.5 if overloaded else 0.75))
+                self._last_cut = time.monotonic()
+            elif not (overloaded or slow):
+                self.limit = min(float(self.max_in_flight), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+        if int(self.limit) < int(limit):
+            reason = 'overloaded' if overloaded else f"slow ({latency:.1f}s)"
+            logger.info(f"Userside is {reason}, reducing concurrent requests to {int(self.limit)}")
+
+
+def is_overloaded(response):
+    """Whether a requests response, or a retry before it, had a 429/5xx status"""
+    retries = getattr(response.raw, 'retries', None)
+    history = retries.history if retries is not None else ()
+    return response.status_code in RETRY_STATUSES or any(item.status in RETRY_STATUSES for item in history)
+
+
+class StreamError(Exception):
+    """A streamed Userside response failed, possibly after some of its records were yielded"""
+
+
+class UsersideAPI:
+    def __init__(self, batch_size=None, max_workers=None, chunk_retries=None, stream_json=None, stats=None,
+                 checkpoint=None):
         self.api_key = os.getenv('USERSIDE_API_KEY')
         self.api_url = os.getenv('USERSIDE_API_URL')
         if not self.api_key or not self.api_url:
             raise ValueError("Please set USERSIDE_API_KEY and USERSIDE_API_URL in .env file")
 
-    def get_commutation_data(self, objects_type):
+        # Batch fetching settings, see get_customer_data and get_houses_data
+        self.batch_size = batch_size or int(os.getenv('USERSIDE_BATCH_SIZE', 500))
+        self.max_workers = max_workers or int(os.getenv('USERSIDE_MAX_WORKERS', 4))
+        # Adaptive budget of all requests, max_workers is where it starts
+        self.limiter = ConcurrencyLimiter(self.max_workers)
+        self.chunk_retries = chunk_retries or int(os.getenv('USERSIDE_CHUNK_RETRIES', 3))
+        self.retry_delay = 1.0
+
+        # HTTP connection pool settings, shared by all requests of this client
+        self.pool_size = int(os.getenv('USERSIDE_POOL_SIZE', max(self.limiter.max_in_flight, 10)))
+        self.timeout = (
+            float(os.getenv('USERSIDE_CONNECT_TIMEOUT', 10)),
+            float(os.getenv('USERSIDE_READ_TIMEOUT', 300))
+        )
+        self.http_retries = int(os.getenv('USERSIDE_HTTP_RETRIES', 3))
+        self.backoff_factor = float(os.getenv('USERSIDE_BACKOFF_FACTOR', 0.5))
+        # Decode huge responses incrementally instead of loading the whole body
+        if stream_json is None:
+            stream_json = os.getenv('USERSIDE_STREAM_JSON', '0') == '1'
+        self.stream_json = stream_json
+        self.stats = stats or RunStats()
+        # Completed chunks are saved to and loaded from the checkpoint, if any
+        self.checkpoint = checkpoint
+        self.session = self._create_session()
+
+    def _create_session(self):
+        """Create HTTP session with keep-alive connection pool, retries and gzip"""
+        retry = Retry(
+            total=self.http_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            # All Userside calls used here are reads, so POST is safe to retry too
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        return session
+
+    def close(self):
+        """Close pooled HTTP connections"""
+        self.session.close()
+
+    def _request(self, method, params, data=None, name='data'):
+        """Send request to Userside API and decode the JSON response once
+
+        Returns:
+            the `data` field of the response, or None on error
+        """
+        call = f"{params['cat']}/{params['action']}"
+        started = self.limiter.acquire()
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(
+                method,
+                f"{self.api_url}",
+                params={'key': self.api_key, **params},
+                data=data,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            decode_start = time.perf_counter()
+            payload = response.json()
+            decode_seconds = time.perf_counter() - decode_start
+        except requests.exceptions.RequestException as e:
+            self.stats.record_api_call(
+                call, time.perf_counter() - start, len(response.content) if response is not None else 0, failed=True
+            )
+            logger.error(f"Error fetching {name}: {e}")
+            return None
+        finally:
+            self._release(started, response)
+
+        failed = payload.get('Result') != 'OK'
+        self.stats.record_api_call(call, time.perf_counter() - start, len(response.content), decode_seconds, failed)
+        if failed:
+            logger.error(f"Error fetching {name}: {payload.get('Result')}")
+            return None
+        return payload.get('data')
+
+    def _stream_data(self, params, name='data'):
+        """Stream the `data` mapping of a Userside API response as (id, record) pairs
+
+        With ijson installed the body is decoded incrementally, one record at a time.
+        Without it the response is decoded in one pass and its items are yielded.
+        Recorded request time includes the time spent by the consumer between records.
+
+        Raises:
+            StreamError: the request failed or the connection dropped or the JSON broke
+                partway through, the records yielded so far are incomplete
+        """
+        call = f"{params['cat']}/{params['action']}"
+        ijson = optional_import('ijson')
+        # Reading response.raw raises urllib3 errors, not the wrapped requests ones
+        errors = (requests.exceptions.RequestException, Urllib3Error, ValueError)
+        if ijson is not None:
+            errors += (ijson.JSONError,)
+        started = self.limiter.acquire()
+        start = time.perf_counter()
+        downloaded = 0
+        failed = True
+        response = None
+        try:
+            try:
+                response = self.session.get(
+                    f"{self.api_url}",
+                    params={'key': self.api_key, **params},
+                    timeout=self.timeout,
+                    stream=True
+                )
+            finally:
+                # The slot is freed once the headers arrive, the consumer may send requests of its own
+                self._release(started, response)
+            with response:
+                response.raise_for_status()
+                if ijson is None:
+                    payload = response.json()
+                    downloaded = len(response.content)
+                    if payload.get('Result') != 'OK':
+                        logger.error(f"Error fetching {name}: {payload.get('Result')}")
+                        return
+                    failed = False
+                    data = payload.get('data') or {}
+                    yield from data.items()
+                    return
+
+                # Let urllib3 handle gzip so ijson reads plain JSON
+                response.raw.decode_content = True
+                result = None
+                key = None
+                builder = None
+                for prefix, event, value in ijson.parse(response.raw, use_float=True):
+                    if builder is not None:
+                        if prefix == 'data' and event in ('map_key', 'end_map'):
+                            yield key, builder.value
+                            builder = None
+                        else:
+                            builder.event(event, value)
+                            continue
+                    if prefix == 'Result' and event == 'string':
+                        result = value
+                        if result != 'OK':
+                            logger.error(f"Error fetching {name}: {result}")
+                            return
+                    elif prefix == 'data' and event == 'map_key':
+                        key = value
+                        builder = ijson.ObjectBuilder()
+                failed = result != 'OK'
+                downloaded = response.raw.tell()
+        except errors as e:
+            logger.error(f"Error fetching {name}: {e}")
+            raise StreamError(f"{name} download failed: {e}") from e
+        finally:
+            self.stats.record_api_call(call, time.perf_counter() - start, downloaded, failed=failed)
+
+    def _release(self, started, response):
+        """Give the limiter slot back, reporting how the server answered"""
+        if response is None:
+            self.stats.count('api_overloaded')
+            self.limiter.release(started, overloaded=True)
+            return
+        overloaded = is_overloaded(response)
+        if overloaded:
+            self.stats.count('api_overloaded')
+        self.limiter.release(started, response.elapsed.total_seconds(), overloaded)
+
+    def _fetch_chunk(self, fetch_func, chunk, name):
+        """Fetch one chunk of ids, retrying transient failures"""
+        if self.checkpoint is not None:
+            data = self.checkpoint.load_chunk(name, chunk)
+            if data is not None:
+                return data
+        for attempt in range(1, self.chunk_retries + 1):
+            data = fetch_func(chunk)
+            if data is not None:
+                if self.checkpoint is not None:
+                    self.checkpoint.save_chunk(name, chunk, data)
+                return data
+            if attempt < self.chunk_retries:
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f"Retrying {name} chunk of {len(chunk)} ids in {delay:.0f}s (attempt {attempt}/{self.chunk_retries})")
+                time.sleep(delay)
+        return None
+
+    def _fetch_in_chunks(self, fetch_func, ids, name, batch_size=None):
+        """Split ids into batches, fetch them in parallel and merge the results
+
+        Returns:
+            dict: merged data of all fetched chunks, or None if every chunk failed
+        """
+        chunks = chunk_list(sorted(ids, key=str), batch_size or self.batch_size)
+        if not chunks:
+            return {}
+
+        merged = {}
+        failed = 0
+        # Enough threads for the highest limit, the limiter decides how many send at once
+        with ThreadPoolExecutor(max_workers=min(self.limiter.max_in_flight, len(chunks))) as executor:
+            futures = [executor.submit(self._fetch_chunk, fetch_func, chunk, name) for chunk in chunks]
+            for future in as_completed(futures):
+                data = future.result()
+                if data is None:
+                    failed += 1
+                elif isinstance(data, dict):
+                    # Userside returns an empty list instead of an empty object
+                    merged.update(data)
+
+        if failed:
+            self.stats.count('failed_chunks', failed)
+        if failed == len(chunks):
+            return None
+        if failed:
+            logger.warning(f"Failed to fetch {failed} of {len(chunks)} {name} chunks, continuing with partial data")
+        return merged
+
+    def get_commutation_data(self, objects_type, object_ids=None):
         """
-        Fetch commutation data from Userside API
+        Fetch commutation data from Userside API, of all objects or only of `object_ids`
         
         Returns:
             dict: 
@@ -42,54 +654,76 @@ class UsersideAPI:
                 }
             }
         """
-        try:
-            response = requests.get(
-                f"{self.api_url}",
-                params={
-                    'key': self.api_key,
-                    'cat': 'commutation',
-                    'action': 'get_data',
-                    'object_type': objects_type
-                }
+        if object_ids is not None:
+            return self._fetch_in_chunks(
+                lambda chunk: self._get_commutation_chunk(objects_type, chunk), object_ids, f'{objects_type} commutation'
             )
-            response.raise_for_status()
-            if response.json().get('Result') == 'OK':   
-                return response.json().get('data')
-            else:
-                print(f"Error fetching data: {response.json().get('Result')}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            return None
 
-    
-        """Fetch device data from Userside API"""
-        try:
-            response = requests.get(
-                f"{self.api_url}",
-                params={
-                    'key': self.api_key,
-                    'cat': 'device',
-                    'action': 'get_data',
-                    'object_type': str(device_type),
-                    'object_id': str(device_id)
-                }
-            )
-            response.raise_for_status()
-            if response.json().get('Result') == 'OK':   
-                return response.json().get('data')
-            else:
-                print(f"Error fetching data: {response.json().get('Result')}")
+        params = {
+            'cat': 'commutation',
+            'action': 'get_data',
+            'object_type': objects_type
+        }
+        if self.stream_json:
+            try:
+                return dict(self._stream_data(params, 'commutation data')) or None
+            except StreamError:
                 return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching device data: {e}")
-            return None
-        
-    def get_all_devices_data(self):
-        """Fetch all devices data from Userside API and save to cache
-        
+        return self._request('get', params, name='commutation data')
+
+    def _get_commutation_chunk(self, objects_type, object_ids: list):
+        """Fetch commutation data of one batch of objects from Userside API"""
+        return self._request(
+            'post',
+            {
+                'cat': 'commutation',
+                'action': 'get_data',
+                'object_type': objects_type
+            },
+            data={
+                'object_id': list_to_string(object_ids)
+            },
+            name='commutation data'
+        )
+
+    def get_device_data(self, device_type, device_id):
+        """Fetch device data from Userside API
+
         Returns:
-            dict: 
+            dict: {"8043": {...}}, same record format as iter_devices_data
+        """
+        data = self._request(
+            'get',
+            {
+                'cat': 'device',
+                'action': 'get_data',
+                'object_type': str(device_type),
+                'object_id': str(device_id)
+            },
+            name='device data'
+        )
+        if isinstance(data, dict) and 'id' in data:
+            # Single record without the id mapping around it
+            return {str(device_id): data}
+        return data
+
+    def get_devices_data(self, device_ids: list, device_type='switch'):
+        """Fetch several devices one by one, in parallel
+
+        Returns:
+            dict: merged get_device_data results, or None if every request failed
+        """
+        return self._fetch_in_chunks(
+            lambda chunk: self.get_device_data(device_type, chunk[0]),
+            device_ids,
+            f'{device_type} device',
+            batch_size=1
+        )
+
+    def iter_devices_data(self, device_type):
+        """Stream all devices of a type (e.g. "all", "onu") as (device_id, device) pairs
+
+        The pairs are the items of the `data` mapping of the response:
             {
                 "Result": "OK",
                 "data": {
@@ -267,28 +901,17 @@ class UsersideAPI:
                 }
             }
         """
-        try:
-            response = requests.get(
-                f"{self.api_url}",
-                params={
-                    'key': self.api_key,
-                    'cat': 'device',
-                    'action': 'get_data',
-                    'object_type': 'all'
-                }
-            )
-            response.raise_for_status()
-            if response.json().get('Result') == 'OK':
-                return response.json().get('data')
-            else:
-                print(f"Error fetching data: {response.json().get('Result')}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            return None
+        return self._stream_data(
+            {
+                'cat': 'device',
+                'action': 'get_data',
+                'object_type': str(device_type)
+            },
+            'devices data'
+        )
 
     def get_customer_data(self, customers_ids: list):
-        """Fetch customer data from Userside API
+        """Fetch customer data from Userside API in parallel batches of `batch_size` ids
         
         Returns:
             dict: 
@@ -359,30 +982,46 @@ class UsersideAPI:
                 }
             }
         """
-        try:
-            response = requests.post(
-                f"{self.api_url}",
-                params={
-                    'key': self.api_key,
-                    'cat': 'customer',
-                    'action': 'get_data'
-                },
-                data={
-                    'customer_id': list_to_string(customers_ids)
-                }
-            )
-            response.raise_for_status()
-            if response.json().get('Result') == 'OK':   
-                return response.json().get('data')
-            else:
-                print(f"Error fetching data: {response.json().get('Result')}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching customer data: {e}")
+        return self._fetch_in_chunks(self._get_customer_chunk, customers_ids, 'customer')
+
+    def get_customer_ids(self, building_ids=None, group_ids=None):
+        """Fetch ids of customers connected in the given houses and belonging to the given groups
+
+        Returns:
+            list: customer ids as strings, or None on error
+        """
+        params = {
+            'cat': 'customer',
+            'action': 'get_customers_id'
+        }
+        if building_ids:
+            params['house_id'] = list_to_string(building_ids)
+        if group_ids:
+            params['group_id'] = list_to_string(group_ids)
+        data = self._request('get', params, name='customer ids')
+        if data is None:
             return None
+        # A comma separated string, a list or an object keyed by id depending on the Userside version
+        if isinstance(data, str):
+            data = data.split(',') if data else []
+        return [str(customer_id) for customer_id in data]
+
+    def _get_customer_chunk(self, customers_ids: list):
+        """Fetch one batch of customers from Userside API"""
+        return self._request(
+            'post',
+            {
+                'cat': 'customer',
+                'action': 'get_data'
+            },
+            data={
+                'customer_id': list_to_string(customers_ids)
+            },
+            name='customer data'
+        )
 
     def get_houses_data(self, building_ids: list):
-        """Fetch houses data from Userside API
+        """Fetch houses data from Userside API in parallel batches of `batch_size` ids
         
         Returns:
             dict:
@@ -415,148 +1054,2102 @@ class UsersideAPI:
                 ...
             } 
         """
+        return self._fetch_in_chunks(self._get_houses_chunk, building_ids, 'house')
+
+    def _get_houses_chunk(self, building_ids: list):
+        """Fetch one batch of houses from Userside API"""
+        return self._request(
+            'post',
+            {
+                'cat': 'address',
+                'action': 'get_house'
+            },
+            data={
+                'building_id': list_to_string(building_ids)
+            },
+            name='houses data'
+        )
+
+
+class AsyncUsersideAPI:
+    """Asynchronous Userside API client for the pipelined fetch, see fetch_export_data_async
+
+    Uses the settings of a UsersideAPI instance and shares its ConcurrencyLimiter.
+    """
+
+    def __init__(self, api):
+        httpx = optional_import('httpx')
+        if httpx is None:
+            raise ValueError("Async mode requires httpx, install it with `pip install httpx`")
+        self.http_errors = (httpx.HTTPError, ValueError)
+
+        self.api_key = api.api_key
+        self.api_url = api.api_url
+        self.batch_size = api.batch_size
+        self.limiter = api.limiter
+        self.chunk_retries = api.chunk_retries
+        self.retry_delay = api.retry_delay
+        self.http_retries = api.http_retries
+        self.backoff_factor = api.backoff_factor
+        self.stats = api.stats
+        self.checkpoint = api.checkpoint
+        connect_timeout, read_timeout = api.timeout
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=api.pool_size, max_keepalive_connections=api.pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _request(self, method, params, data=None, name='data'):
+        """Send request to Userside API, retrying 429/5xx responses with backoff
+
+        Returns:
+            the `data` field of the response, or None on error
+        """
+        call = f"{params['cat']}/{params['action']}"
+        start = time.perf_counter()
+        response = None
+        started = await self.limiter.acquire_async()
+        overloaded = True
         try:
-            response = requests.post(
-                f"{self.api_url}",
-                params={
-                    'key': self.api_key,
-                    'cat': 'address',
-                    'action': 'get_house'
-                },
-                data={
-                    'building_id': list_to_string(building_ids)
-                }
-            )
+            try:
+                for attempt in range(self.http_retries + 1):
+                    response = await self.client.request(
+                        method, f"{self.api_url}", params={'key': self.api_key, **params}, data=data
+                    )
+                    if response.status_code not in RETRY_STATUSES:
+                        overloaded = attempt > 0
+                        break
+                    if attempt == self.http_retries:
+                        break
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else self.backoff_factor * 2 ** attempt
+                    await asyncio.sleep(delay)
+            finally:
+                if overloaded:
+                    self.stats.count('api_overloaded')
+                latency = response.elapsed.total_seconds() if response is not None and not overloaded else None
+                self.limiter.release(started, latency, overloaded)
             response.raise_for_status()
-            if response.json().get('Result') == 'OK':
-                return response.json().get('data')
-            else:
-                print(f"Error fetching data: {response.json().get('Result')}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching houses data: {e}")
+            decode_start = time.perf_counter()
+            payload = response.json()
+            decode_seconds = time.perf_counter() - decode_start
+        except self.http_errors as e:
+            self.stats.record_api_call(
+                call, time.perf_counter() - start, len(response.content) if response is not None else 0, failed=True
+            )
+            logger.error(f"Error fetching {name}: {e}")
             return None
 
+        failed = payload.get('Result') != 'OK'
+        self.stats.record_api_call(call, time.perf_counter() - start, len(response.content), decode_seconds, failed)
+        if failed:
+            logger.error(f"Error fetching {name}: {payload.get('Result')}")
+            return None
+        return payload.get('data')
 
-def export_to_excel(data, filename=None):
-    """Export data to Excel file"""
-    if not data:
-        print("No data to export")
-        return
+    async def get_commutation_data(self, objects_type):
+        """Fetch commutation data, see UsersideAPI.get_commutation_data"""
+        return await self._request(
+            'GET',
+            {
+                'cat': 'commutation',
+                'action': 'get_data',
+                'object_type': objects_type
+            },
+            name='commutation data'
+        )
 
-    # Convert data to DataFrame
-    df = pd.DataFrame(data)
-    
-    # Generate filename if not provided
-    if not filename:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"commutation_export_{timestamp}.xlsx"
-    
-    # Export to Excel
-    df.to_excel(filename, index=False)
-    print(f"Data exported successfully to {filename}")
+    async def get_customer_chunk(self, customers_ids: list):
+        """Fetch one batch of customers, see UsersideAPI.get_customer_data"""
+        return await self._request(
+            'POST',
+            {
+                'cat': 'customer',
+                'action': 'get_data'
+            },
+            data={
+                'customer_id': list_to_string(customers_ids)
+            },
+            name='customer data'
+        )
 
+    async def get_houses_chunk(self, building_ids: list):
+        """Fetch one batch of houses, see UsersideAPI.get_houses_data"""
+        return await self._request(
+            'POST',
+            {
+                'cat': 'address',
+                'action': 'get_house'
+            },
+            data={
+                'building_id': list_to_string(building_ids)
+            },
+            name='houses data'
+        )
 
-def transform_houses_data(houses_data):
-    """Transform houses data into simplified format"""
-    transformed_data = {}
-    for house_id, house_info in houses_data.items():
-        transformed_data[house_info.get('building_id')] = {
-            'house_id': house_id,
-            'full_name': house_info.get('full_name')
+    async def _fetch_chunk(self, fetch_func, chunk, name):
+        """Fetch one chunk of ids, retrying transient failures"""
+        if self.checkpoint is not None:
+            data = self.checkpoint.load_chunk(name, chunk)
+            if data is not None:
+                return data
+        for attempt in range(1, self.chunk_retries + 1):
+            data = await fetch_func(chunk)
+            if data is not None:
+                if self.checkpoint is not None:
+                    self.checkpoint.save_chunk(name, chunk, data)
+                return data
+            if attempt < self.chunk_retries:
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f"Retrying {name} chunk of {len(chunk)} ids in {delay:.0f}s (attempt {attempt}/{self.chunk_retries})")
+                await asyncio.sleep(delay)
+        logger.warning(f"Failed to fetch {name} chunk of {len(chunk)} ids, continuing with partial data")
+        return None
+
+    async def iter_chunks(self, fetch_func, ids, name):
+        """Fetch ids in batches concurrently, yielding each batch result as soon as it arrives"""
+        tasks = [
+            asyncio.ensure_future(self._fetch_chunk(fetch_func, chunk, name))
+            for chunk in chunk_list(sorted(ids, key=str), self.batch_size)
+        ]
+        for task in asyncio.as_completed(tasks):
+            data = await task
+            if data is None:
+                self.stats.count('failed_chunks')
+            elif isinstance(data, dict):
+                yield data
+
+
+def project_device(device):
+    """Keep only the device fields used by the export
+
+    Returns:
+        dict: {"location": ..., "hostname": ..., "host": ..., "nazv": ..., "node_id": ...,
+               "ifaces": {"1": "WLAN interface", ...}}
+    """
+    projected = {field: device.get(field) for field in DEVICE_FIELDS}
+    # Only used to scope exports to nodes, see ExportScope
+    projected['node_id'] = device.get('node_id')
+    ifaces = device.get('ifaces') or {}
+    # Userside returns an empty list instead of an empty object
+    if isinstance(ifaces, dict):
+        projected['ifaces'] = {str(iface): data.get('ifName') for iface, data in ifaces.items()}
+    else:
+        projected['ifaces'] = {}
+    return projected
+
+
+class DeviceCache:
+    """Local SQLite cache of projected device data keyed by commutation object type and device id
+
+    Only DEVICE_FIELDS, node ids and interface names are stored, in an indexed table per
+    kind of data. Every device keeps its fetch time, so expired or missing devices can be
+    refreshed individually instead of downloading all devices again. Exports look devices
+    up in a memory-mapped DeviceStore built from the cache, see open_store.
+    """
+
+    def __init__(self, path=DEVICE_CACHE_FILE, ttl=None, full_refresh_threshold=None):
+        self.path = path
+        # Seconds after which a cached device is fetched again
+        self.ttl = ttl if ttl is not None else float(os.getenv('DEVICE_CACHE_TTL', 86400))
+        # Download all devices at once when more than this many are missing or expired
+        self.full_refresh_threshold = full_refresh_threshold or int(os.getenv('DEVICE_CACHE_FULL_REFRESH_AT', 500))
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != DEVICE_CACHE_VERSION:
+            with self.conn:
+                self.conn.execute('DROP TABLE IF EXISTS devices')
+                self.conn.execute('DROP TABLE IF EXISTS device_ifaces')
+                self.conn.execute('DROP TABLE IF EXISTS cache_meta')
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS devices ('
+                'object_type TEXT, id INTEGER, location TEXT, hostname TEXT, host TEXT, nazv TEXT, node_id INTEGER, '
+                'fetched_at REAL, '
+                'PRIMARY KEY (object_type, id))'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS device_ifaces ('
+                'object_type TEXT, device_id INTEGER, iface TEXT, if_name TEXT, '
+                'PRIMARY KEY (object_type, device_id, iface)) WITHOUT ROWID'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(f'PRAGMA user_version = {DEVICE_CACHE_VERSION}')
+
+    def _set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cache_meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM cache_meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def is_empty(self, object_type='switch'):
+        return self.conn.execute(
+            'SELECT 1 FROM devices WHERE object_type = ? LIMIT 1', (object_type,)
+        ).fetchone() is None
+
+    def info(self, object_type='switch'):
+        """Cache metadata: device count of all types, file size and time of the last full download"""
+        full_sync_at = self._get_meta(f'full_sync_at:{object_type}')
+        return {
+            'devices': self.conn.execute('SELECT COUNT(*) FROM devices').fetchone()[0],
+            'size': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            'full_sync_at': float(full_sync_at) if full_sync_at else None
         }
-    return transformed_data
 
-def main():
+    def store(self, devices, object_type='switch', fetched_at=None):
+        """Project and store devices
 
-    try:
-        # Initialize API client
-        api = UsersideAPI()
-        
-        # Fetch commutation data
-        print("Fetching commutation data...")
-        commutation_data = api.get_commutation_data(objects_type='customer')
+        Args:
+            devices: iterable of (device_id, device) pairs, e.g. UsersideAPI.iter_devices_data('all')
+            object_type: commutation object type of the devices
+            fetched_at: fetch time of the devices, now by default
 
-        # Fetch customer data
-        print("Fetching customer data...")
-        if commutation_data:
-            customer_data = api.get_customer_data(customers_ids=[customer_id for customer_id in commutation_data.keys()])
-        else:
-            print("No commutation data found")
+        Returns:
+            int: number of stored devices
+        """
+        fetched_at = fetched_at or time.time()
+        count = 0
+        with self.conn:
+            for device_id, device in devices:
+                projected = project_device(device)
+                device_id = int(device_id)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO devices (object_type, id, location, hostname, host, nazv, node_id, fetched_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (object_type, device_id, *(projected[field] for field in DEVICE_FIELDS), projected['node_id'],
+                     fetched_at)
+                )
+                self.conn.execute(
+                    'DELETE FROM device_ifaces WHERE object_type = ? AND device_id = ?', (object_type, device_id)
+                )
+                self.conn.executemany(
+                    'INSERT INTO device_ifaces (object_type, device_id, iface, if_name) VALUES (?, ?, ?, ?)',
+                    [(object_type, device_id, iface, name) for iface, name in projected['ifaces'].items()]
+                )
+                count += 1
+        if count:
+            self._set_meta(f'changed_at:{object_type}', time.time())
+        return count
 
-        # Fetch houses data
-        print("Fetching houses data...")
-        if commutation_data:
-            # make list of building_ids from customer data
-            building_ids = [customer_data.get(customer_id).get('address')[0].get('house_id') for customer_id in customer_data.keys()]
-            houses_data = api.get_houses_data(building_ids=building_ids)
-            if houses_data:
-                houses_data = transform_houses_data(houses_data)
-            
-        else:
-            print("No customer data found")
-
-        # Fetch all devices data
-        print("Fetching all devices data...")
-        if not os.path.exists('devices_data.json'):
-            print("No devices data found in cache, fetching from Userside API...")
-            all_devices_data = api.get_all_devices_data()
-            with open('devices_data.json', 'w') as f:
-                json.dump(all_devices_data, f)
-        else:
-            print("Devices data found in cache, loading from cache...")
-            with open('devices_data.json', 'r') as f:
-                all_devices_data = json.load(f)
-        
-        if commutation_data:
-            print("Processing commutation data...")
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            data_to_export = []
-
-            # Process each customer's commutation data
-            for customer_id, commutation in commutation_data.items():
-                print(f"Processing object ID: {customer_id}")
-
-                if isinstance(commutation[0], dict):
-                    for commutation in commutation:
-                        device_type = commutation.get('object_type')
-
-                        # Check device type, if switch, get device id from commutation data
-                        # Works only with device_type == 'switch'
-                        
-                        if device_type == 'switch':
-                            device_id = commutation.get('object_id')
-                        else:
-                            continue
-                        
-                        if device_type and device_id:
-                            print(f"Fetching data for device type: {device_type}, id: {device_id}")
-                            device_data = all_devices_data.get(str(device_id))
-
-                            # Device Data to export
-                            data_to_export.append({
-                                'customer_agreement': customer_data.get(customer_id).get('agreement')[0].get('number'),
-                                'customer_name': customer_data.get(customer_id).get('full_name'),
-                                'customer_address': houses_data.get(customer_data.get(customer_id).get('address')[0].get('house_id')).get('full_name') if customer_data.get(customer_id).get('address')[0].get('house_id') in houses_data else '' + ' ' + customer_data.get(customer_id).get('address')[0].get('apartment').get('number') if customer_data.get(customer_id).get('address')[0].get('apartment').get('number') else '',
-                                'device_type': device_type,
-                                'location': device_data.get('location'),
-                                'hostname': device_data.get('hostname'),
-                                'ip': device_data.get('host'),
-                                'name': device_data.get('nazv'),
-                                'iface_data': device_data.get('ifaces').get(str(commutation.get('interface'))).get('ifName')
-                            })
+    def node_index(self):
+        """Ids of cached devices of any type by node id"""
+        nodes = {}
+        for device_id, node_id in self.conn.execute('SELECT DISTINCT id, node_id FROM devices WHERE node_id'):
+            nodes.setdefault(node_id, set()).add(device_id)
+        return nodes
 
-                else:
-                    print(f"Unexpected commutation format: {commutation}")
+    def node_device_ids(self, node_ids):
+        """Ids of cached devices of any type placed in the given nodes"""
+        node_ids = [int(node_id) for node_id in node_ids]
+        placeholders = ','.join('?' * len(node_ids))
+        return {
+            device_id for device_id, in self.conn.execute(
+                f'SELECT DISTINCT id FROM devices WHERE node_id IN ({placeholders})', node_ids
+            )
+        }
 
-            # Export to Excel
-            export_to_excel(data=data_to_export, filename=f"commutation_export_{timestamp}.xlsx")
-            
-        else:
-            print("Failed to fetch commutation data from Userside API")
-            
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    def store_path(self, object_type='switch'):
+        return f"{os.path.splitext(self.path)[0]}.{object_type}.store"
+
+    def build_store(self, object_type='switch'):
+        """Write the cached devices of a type to a DeviceStore file
+
+        Returns:
+            int: number of devices in the store
+        """
+        devices = self.conn.execute(
+            'SELECT id, location, hostname, host, nazv FROM devices WHERE object_type = ? ORDER BY id',
+            (object_type,)
+        )
+        ifaces = self.conn.execute(
+            'SELECT device_id, iface, if_name FROM device_ifaces WHERE object_type = ? ORDER BY device_id',
+            (object_type,)
+        )
+
+        def records():
+            # Merge the two id ordered cursors
+            iface = next(ifaces, None)
+            for device_id, *fields in devices:
+                device_ifaces = {}
+                while iface is not None and iface[0] <= device_id:
+                    if iface[0] == device_id:
+                        device_ifaces[iface[1]] = iface[2]
+                    iface = next(ifaces, None)
+                yield device_id, [*fields, device_ifaces]
+
+        path = self.store_path(object_type)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        count = DeviceStore.write(tmp_path, records())
+        os.replace(tmp_path, path)
+        return count
+
+    def open_store(self, object_type='switch'):
+        """Open the DeviceStore of a type, building it first if it is missing or older than the cache"""
+        path = self.store_path(object_type)
+        changed_at = float(self._get_meta(f'changed_at:{object_type}', 0))
+        if os.path.exists(path):
+            try:
+                store = DeviceStore(path)
+                if store.built_at >= changed_at:
+                    return store
+                store.close()
+            except ValueError as e:
+                logger.warning(f"Rebuilding devices store {path}: {e}")
+        logger.info(f"Building {object_type} devices store {path}...")
+        count = self.build_store(object_type)
+        logger.debug(f"{count} {object_type} devices written to {path}")
+        return DeviceStore(path)
+
+    def rebuild(self, devices, object_type='switch'):
+        """Replace all cached devices of a type with freshly downloaded ones
+
+        The new cache is written to a temporary file together with the cached devices
+        of other types and renamed over the old one, so an interrupted download never
+        leaves a partial cache behind.
+
+        Returns:
+            int: number of stored devices, 0 keeps the old cache untouched
+        """
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        tmp_cache = DeviceCache(tmp_path)
+        try:
+            try:
+                count = tmp_cache.store(devices, object_type)
+            except StreamError:
+                # A partial download is not a full sync
+                logger.warning(f"Download of {object_type} devices failed, keeping the cached ones")
+                count = 0
+            if count:
+                # Keep cached devices of other types
+                tmp_cache.conn.execute('ATTACH DATABASE ? AS old', (self.path,))
+                with tmp_cache.conn:
+                    tmp_cache.conn.execute(
+                        'INSERT INTO devices SELECT * FROM old.devices WHERE object_type != ?', (object_type,)
+                    )
+                    tmp_cache.conn.execute(
+                        'INSERT INTO device_ifaces SELECT * FROM old.device_ifaces WHERE object_type != ?',
+                        (object_type,)
+                    )
+                    tmp_cache.conn.execute('INSERT OR IGNORE INTO cache_meta SELECT * FROM old.cache_meta')
+                tmp_cache.conn.execute('DETACH DATABASE old')
+                tmp_cache._set_meta(f'full_sync_at:{object_type}', time.time())
+        finally:
+            tmp_cache.close()
+
+        if not count:
+            os.remove(tmp_path)
+            return 0
+
+        self.conn.close()
+        os.replace(tmp_path, self.path)
+        self._connect()
+        return count
+
+    def refresh(self, api, device_ids, object_type='switch', full=False):
+        """Make sure the given devices are cached and not older than the TTL
+
+        Missing or expired devices are fetched one by one. An empty cache, a forced
+        full refresh or too many devices to fetch trigger a full download instead.
+
+        Returns:
+            int: number of fetched devices
+        """
+        if not full and not self.is_empty(object_type):
+            expired_before = time.time() - self.ttl
+            fetched_at = dict(self.conn.execute(
+                'SELECT id, fetched_at FROM devices WHERE object_type = ?', (object_type,)
+            ))
+            to_fetch = sorted({
+                int(device_id) for device_id in device_ids
+                if fetched_at.get(int(device_id), 0) < expired_before
+            })
+            if not to_fetch:
+                return 0
+            if len(to_fetch) <= self.full_refresh_threshold:
+                logger.info(f"Fetching {len(to_fetch)} missing or expired {object_type} devices...")
+                devices = api.get_devices_data(to_fetch, device_type=object_type) or {}
+                return self.store(devices.items(), object_type)
+
+        logger.info(f"Fetching all {object_type} devices data from Userside API...")
+        return self.rebuild(api.iter_devices_data(DEVICE_FETCH_TYPES.get(object_type, object_type)), object_type)
+
+    def close(self):
+        self.conn.close()
+
+
+class DeviceStore:
+    """Read-only memory-mapped device lookup file, built by DeviceCache.build_store
+
+    Layout: header, sorted int64 device ids, uint64 record offsets and JSON records
+    [location, hostname, host, nazv, {iface: if_name}]. Lookups bisect the id array in
+    place, so opening the store takes the same time for any number of devices and only
+    the pages of the devices looked up are read from disk.
+    """
+
+    HEADER = struct.Struct('<4sIQd')
+    MAGIC = b'UDS1'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.built_at = self.HEADER.unpack_from(self.mmap, 0)
+        if magic != self.MAGIC or version != DEVICE_STORE_VERSION:
+            self.mmap.close()
+            self.file.close()
+            raise ValueError(f"unsupported devices store version {version}")
+
+        ids_start = self.HEADER.size
+        offsets_start = ids_start + 8 * self.count
+        self.data_start = offsets_start + 8 * (self.count + 1)
+        self._view = memoryview(self.mmap)
+        self.ids = self._view[ids_start:offsets_start].cast('q')
+        self.offsets = self._view[offsets_start:self.data_start].cast('Q')
+
+    @classmethod
+    def write(cls, path, records):
+        """Write (device_id, [location, hostname, host, nazv, ifaces]) records sorted by id
+
+        Returns:
+            int: number of written records
+        """
+        ids = array.array('q')
+        offsets = array.array('Q', [0])
+        with open(f"{path}.data", 'w+b') as data:
+            for device_id, record in records:
+                ids.append(device_id)
+                data.write(json.dumps(record, ensure_ascii=False).encode())
+                offsets.append(data.tell())
+
+            with open(path, 'wb') as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, DEVICE_STORE_VERSION, len(ids), time.time()))
+                f.write(ids.tobytes())
+                f.write(offsets.tobytes())
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+        os.remove(f"{path}.data")
+        return len(ids)
+
+    def get(self, device_id):
+        """Get a device
+
+        Returns:
+            dict: {"location": ..., "hostname": ..., "host": ..., "nazv": ..., "ifaces": {"1": "WLAN interface"}},
+            or None if the device is not in the store
+        """
+        index = bisect.bisect_left(self.ids, device_id)
+        if index == self.count or self.ids[index] != device_id:
+            return None
+        start = self.data_start + self.offsets[index]
+        end = self.data_start + self.offsets[index + 1]
+        *fields, ifaces = json.loads(self.mmap[start:end])
+        return {**dict(zip(DEVICE_FIELDS, fields)), 'ifaces': ifaces}
+
+    def close(self):
+        # Views into the map must be released before it can be closed
+        self.ids.release()
+        self.offsets.release()
+        self._view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+class RecordCache:
+    """Local SQLite cache of raw Userside records keyed by id, e.g. customers or houses
+
+    Each record keeps its fetch time, so only new ids and records older than
+    `max_age` seconds are requested from Userside on the next run.
+    """
+
+    def __init__(self, table, max_age, path=RECORD_CACHE_FILE, key_field=None):
+        self.table = table
+        self.max_age = max_age
+        self.path = path
+        # Record field to key by instead of the id in the API response
+        self.key_field = key_field
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            # Tables of the same database are versioned one by one, PRAGMA user_version covers all of them
+            self.conn.execute('CREATE TABLE IF NOT EXISTS record_cache_meta (name TEXT PRIMARY KEY, version INTEGER)')
+            row = self.conn.execute('SELECT version FROM record_cache_meta WHERE name = ?', (table,)).fetchone()
+            # Caches written before the meta table only kept the database version
+            version = row[0] if row else self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != RECORD_CACHE_VERSION:
+                self.conn.execute(f'DROP TABLE IF EXISTS {self.table}')
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, data TEXT, fetched_at REAL)'
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO record_cache_meta (name, version) VALUES (?, ?)', (table, RECORD_CACHE_VERSION)
+            )
+
+    def store(self, records, fetched_at=None):
+        """Store (id, record) pairs
+
+        Returns:
+            int: number of stored records
+        """
+        fetched_at = fetched_at or time.time()
+        rows = [
+            (str(record.get(self.key_field) if self.key_field else record_id), json.dumps(record), fetched_at)
+            for record_id, record in records
+        ]
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO {self.table} (id, data, fetched_at) VALUES (?, ?, ?)', rows
+            )
+        return len(rows)
+
+    def _select(self, columns, ids):
+        for chunk in chunk_list(ids, 500):
+            placeholders = ','.join('?' * len(chunk))
+            yield from self.conn.execute(
+                f'SELECT id, {columns} FROM {self.table} WHERE id IN ({placeholders})', chunk
+            )
+
+    def get_many(self, ids):
+        """Get cached records
+
+        Returns:
+            dict: {id: record} for the ids found in cache
+        """
+        return {record_id: json.loads(data) for record_id, data in self._select('data', list(ids))}
+
+    def expired_ids(self, ids):
+        """Ids that are not cached or are older than `max_age`"""
+        expired_before = time.time() - self.max_age
+        fresh = {
+            record_id for record_id, fetched_at in self._select('fetched_at', list(ids))
+            if fetched_at >= expired_before
+        }
+        return [record_id for record_id in ids if record_id not in fresh]
+
+    def fetch(self, ids, fetch_func, full=False):
+        """Get records for ids, fetching only new or expired ones from Userside
+
+        Args:
+            ids: record ids to get
+            fetch_func: function fetching a list of ids, e.g. UsersideAPI.get_customer_data
+            full: fetch all ids regardless of their age
+
+        Returns:
+            dict: {id: record} for all ids known to Userside or the cache
+        """
+        ids = list(dict.fromkeys(str(record_id) for record_id in ids))
+        to_fetch = ids if full else self.expired_ids(ids)
+        if to_fetch:
+            logger.info(f"Fetching {len(to_fetch)} of {len(ids)} {self.table} from Userside API...")
+            data = fetch_func(to_fetch)
+            if data:
+                self.store(data.items())
+        else:
+            logger.info(f"All {len(ids)} {self.table} found in cache")
+        return self.get_many(ids)
+
+    def close(self):
+        self.conn.close()
+
+
+class ExportState:
+    """Fingerprints of the rows of the last --since-last export, keyed by connect_id
+
+    Rows of the current export are compared with the stored fingerprints and only added,
+    changed and removed rows are passed on. The new state is written to a staging table
+    and replaces the stored one on `commit`, so a failed export is diffed again next run.
+    """
+
+    def __init__(self, path=RECORD_CACHE_FILE, table='export_state'):
+        self.table = table
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} (connect_id TEXT PRIMARY KEY, fingerprint TEXT, data TEXT)'
+            )
+            self.conn.execute(f'DROP TABLE IF EXISTS {self.table}_new')
+            self.conn.execute(
+                f'CREATE TABLE {self.table}_new (connect_id TEXT PRIMARY KEY, fingerprint TEXT, data TEXT)'
+            )
+
+    @staticmethod
+    def fingerprint(row):
+        values = json.dumps([row.get(column) for column in EXPORT_COLUMNS], default=str)
+        return hashlib.blake2b(values.encode(), digest_size=8).hexdigest()
+
+    def diff(self, rows, current_ids=None, batch_size=10000):
+        """Yield rows that differ from the last export, with a change_type column
+
+        Rows of the last export that are missing from `rows` but whose connect_id is in
+        `current_ids` still exist in Userside and could not be resolved this time, e.g. a
+        device that failed to download. They keep their previous state instead of showing
+        up as removed, and are counted in `unresolved`.
+
+        Args:
+            rows: export rows with a connect_id key, e.g. iter_export_rows()
+            current_ids: connect_ids of all commutations of supported object types, see commutation_keys
+
+        Yields:
+            dict: DIFF_COLUMNS row, change_type is "added", "changed" or "removed"
+        """
+        current_ids = current_ids or set()
+        self.unresolved = 0
+        previous = dict(self.conn.execute(f'SELECT connect_id, fingerprint FROM {self.table}'))
+        batch = []
+        for row in rows:
+            connect_id = str(row['connect_id'])
+            fingerprint = self.fingerprint(row)
+            old_fingerprint = previous.pop(connect_id, None)
+            if old_fingerprint != fingerprint:
+                yield {**row, 'change_type': 'added' if old_fingerprint is None else 'changed'}
+
+            values = {column: row.get(column) for column in EXPORT_COLUMNS}
+            batch.append((connect_id, fingerprint, json.dumps(values, default=str)))
+            if len(batch) >= batch_size:
+                self._stage(batch)
+                batch = []
+        self._stage(batch)
+
+        unresolved = [connect_id for connect_id in previous if connect_id in current_ids]
+        for chunk in chunk_list(unresolved, 500):
+            placeholders = ','.join('?' * len(chunk))
+            with self.conn:
+                self.conn.execute(
+                    f'INSERT INTO {self.table}_new SELECT * FROM {self.table} WHERE connect_id IN ({placeholders})', chunk
+                )
+        self.unresolved = len(unresolved)
+
+        # Other rows left in the previous state are gone from Userside
+        removed_ids = [connect_id for connect_id in previous if connect_id not in current_ids]
+        for chunk in chunk_list(removed_ids, 500):
+            placeholders = ','.join('?' * len(chunk))
+            removed = self.conn.execute(
+                f'SELECT connect_id, data FROM {self.table} WHERE connect_id IN ({placeholders})', chunk
+            )
+            for removed_id, data in removed.fetchall():
+                yield {**json.loads(data), 'connect_id': removed_id, 'change_type': 'removed'}
+
+    def _stage(self, rows):
+        with self.conn:
+            self.conn.executemany(f'INSERT OR REPLACE INTO {self.table}_new VALUES (?, ?, ?)', rows)
+
+    def commit(self):
+        """Make the rows seen by `diff` the state for the next run"""
+        with self.conn:
+            self.conn.execute(f'DROP TABLE {self.table}')
+            self.conn.execute(f'ALTER TABLE {self.table}_new RENAME TO {self.table}')
+
+    def close(self):
+        self.conn.close()
+
+
+class XlsxSink:
+    """Excel writer that streams rows to disk with a write-only openpyxl workbook"""
+
+    def __init__(self, filename, columns=EXPORT_COLUMNS):
+        self.filename = filename
+        self.columns = columns
+        from openpyxl import Workbook
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Sheet1')
+        self.sheet.append(list(columns))
+
+    def write(self, row):
+        self.sheet.append([row.get(column) for column in self.columns])
+
+    def close(self):
+        self.workbook.save(self.filename)
+
+
+class CsvSink:
+    """CSV writer that writes rows to disk as they come"""
+
+    def __init__(self, filename, columns=EXPORT_COLUMNS):
+        self.filename = filename
+        self.file = open(filename, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=columns, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """Parquet writer that flushes rows to disk in row groups of `batch_size` rows"""
+
+    def __init__(self, filename, columns=EXPORT_COLUMNS, batch_size=50000):
+        self.pa = optional_import('pyarrow')
+        if self.pa is None:
+            raise ValueError("Parquet export requires pyarrow, install it with `pip install pyarrow`")
+        pq = optional_import('pyarrow.parquet')
+
+        self.filename = filename
+        self.columns = columns
+        self.batch_size = batch_size
+        self.schema = self.pa.schema([(column, self.pa.string()) for column in columns])
+        self.writer = pq.ParquetWriter(filename, self.schema)
+        self.batch = []
+
+    def write(self, row):
+        self.batch.append({
+            column: None if row.get(column) is None else str(row.get(column))
+            for column in self.columns
+        })
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            self.writer.write_table(self.pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+class JsonLinesSink:
+    """JSON lines writer, one object per row"""
+
+    def __init__(self, filename, columns=EXPORT_COLUMNS):
+        self.columns = columns
+        self.file = open(filename, 'w', encoding='utf-8')
+
+    def write(self, row):
+        values = {column: row.get(column) for column in self.columns}
+        self.file.write(json.dumps(values, ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+# Export formats selectable with --format
+SINKS = {
+    'xlsx': XlsxSink,
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+    'jsonl': JsonLinesSink
+}
+
+
+class ProgressLogger:
+    """Log progress of a long loop at most every `interval` seconds"""
+
+    def __init__(self, label, total=None, interval=5.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.started = self.last_logged = time.perf_counter()
+
+    def update(self, value=1):
+        self.count += value
+        now = time.perf_counter()
+        if now - self.last_logged >= self.interval:
+            self.last_logged = now
+            self.log(now)
+
+    def log(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.started
+        rate = self.count / elapsed if elapsed else 0
+        of_total = f"/{self.total}" if self.total else ''
+        logger.info(f"{self.count}{of_total} {self.label} ({rate:.0f}/s)")
+
+
+def default_filename(export_format):
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"commutation_export_{timestamp}.{export_format}"
+
+
+def export_rows(rows, export_format='xlsx', filename=None, stats=None, columns=EXPORT_COLUMNS):
+    """Write rows to a file as they are produced, without collecting them in memory
+
+    Args:
+        rows: iterable of dicts with EXPORT_COLUMNS keys, e.g. iter_export_rows()
+        export_format: one of SINKS
+        filename: output file, commutation_export_<timestamp>.<format> by default
+        stats: RunStats receiving the time spent producing ("join") and writing ("write") rows
+        columns: columns to write, DIFF_COLUMNS for --since-last rows
+
+    Returns:
+        int: number of exported rows
+    """
+    filename = filename or default_filename(export_format)
+    # Rows go to a temporary file renamed once complete, a failed export never leaves a partial file
+    tmp_filename = f"{filename}.tmp"
+    sink = SINKS[export_format](tmp_filename, columns)
+    progress = ProgressLogger('rows exported')
+    join_seconds = write_seconds = 0.0
+    rows = iter(rows)
+    count = 0
+    try:
+        try:
+            while True:
+                start = time.perf_counter()
+                row = next(rows, None)
+                written = time.perf_counter()
+                join_seconds += written - start
+                if row is None:
+                    break
+                sink.write(row)
+                write_seconds += time.perf_counter() - written
+                count += 1
+                progress.update()
+        finally:
+            start = time.perf_counter()
+            sink.close()
+            write_seconds += time.perf_counter() - start
+            if stats is not None:
+                stats.add_time('join', join_seconds)
+                stats.add_time('write', write_seconds)
+                stats.count('rows', count)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    if not count:
+        os.remove(tmp_filename)
+        logger.warning("No data to export")
+    else:
+        os.replace(tmp_filename, filename)
+        logger.info(f"Data exported successfully to {filename}")
+    return count
+
+
+# Commutation object type -> resolver class, see register_resolver
+RESOLVERS = {}
+
+
+def register_resolver(*object_types):
+    """Class decorator registering a resolver for commutation object types
+
+    A resolver is created per export with resolver_class(object_type, device_cache) and provides:
+        prefetch(api, object_ids, full): bulk-fetch whatever the rows of these objects need
+        build_index(object_ids): load the fetched data for fast lookups
+        resolve(object_id, interface): device columns of an export row, or None to skip it
+    """
+    def decorator(resolver_class):
+        for object_type in object_types:
+            RESOLVERS[object_type] = resolver_class
+        return resolver_class
+    return decorator
+
+
+@register_resolver('switch', 'onu')
+class DeviceResolver:
+    """Active equipment downloaded with device/get_data and kept in DeviceCache"""
+
+    def __init__(self, object_type, device_cache):
+        self.object_type = object_type
+        self.device_cache = device_cache
+        self.store = None
+        self._lookup = None
+
+    def prefetch(self, api, object_ids, full=False):
+        count = self.device_cache.refresh(api, object_ids, self.object_type, full=full)
+        info = self.device_cache.info(self.object_type)
+        logger.info(f"Devices cache: {count} {self.object_type} devices fetched, {info['devices']} cached, "
+                    f"{info['size'] / 1024 / 1024:.1f} MB")
+
+    def build_index(self, object_ids):
+        # Devices are looked up in the memory-mapped store on first use instead of loaded up front
+        self.store = self.device_cache.open_store(self.object_type)
+        self._lookup = lru_cache(maxsize=DEVICE_LOOKUP_CACHE_SIZE)(self.store.get)
+
+    def resolve(self, object_id, interface):
+        device = self._lookup(object_id)
+        if device is None:
+            return None
+        return {
+            'location': device['location'],
+            'hostname': device['hostname'],
+            'ip': device['host'],
+            'name': device['nazv'],
+            'iface_data': device['ifaces'].get(str(interface))
+        }
+
+
+@register_resolver('cross', 'splitter', 'fiber')
+class PassiveResolver:
+    """Passive equipment (cross boxes, splitters, fibers): no device data, rows carry the object id and port"""
+
+    def __init__(self, object_type, device_cache):
+        self.object_type = object_type
+
+    def prefetch(self, api, object_ids, full=False):
+        pass
+
+    def build_index(self, object_ids):
+        pass
+
+    def resolve(self, object_id, interface):
+        return {
+            'location': None,
+            'hostname': None,
+            'ip': None,
+            'name': f"{self.object_type} #{object_id}",
+            'iface_data': None if interface is None else str(interface)
+        }
+
+
+def referenced_objects(commutation_data):
+    """Ids of commutation objects grouped by object type
+
+    Returns:
+        dict: {"switch": {6918, ...}, "onu": {...}}
+    """
+    objects = {}
+    for commutations in (commutation_data or {}).values():
+        if not isinstance(commutations, list):
+            continue
+        for commutation in commutations:
+            if isinstance(commutation, dict) and commutation.get('object_id'):
+                objects.setdefault(commutation.get('object_type'), set()).add(int(commutation['object_id']))
+    return objects
+
+
+def create_resolvers(api, device_cache, objects, full=False, prefetch=True, downloaded=()):
+    """Create resolvers for the referenced object types and bulk-fetch their data, one pass per type
+
+    With `prefetch` off only the already fetched data is indexed, e.g. on --resume.
+    Object types in `downloaded` were fully downloaded earlier in the run, e.g. by the
+    background download of fetch_export_data_async, and only fill in missing objects.
+
+    Returns:
+        dict: {object_type: resolver} for the supported object types
+    """
+    resolvers = {}
+    for object_type, object_ids in objects.items():
+        resolver_class = RESOLVERS.get(object_type)
+        if resolver_class is None:
+            logger.warning(f"Unsupported commutation object type: {object_type}, skipping {len(object_ids)} objects")
+            continue
+        resolver = resolver_class(object_type, device_cache)
+        if prefetch:
+            resolver.prefetch(api, object_ids, full=full and object_type not in downloaded)
+        resolver.build_index(object_ids)
+        resolvers[object_type] = resolver
+    return resolvers
+
+
+def format_customer_address(customer, houses_data):
+    """Customer connection address: house full name followed by the apartment number"""
+    address = (customer.get('address') or [{}])[0]
+    house = houses_data.get(address.get('house_id')) or {}
+    apartment = (address.get('apartment') or {}).get('number')
+    return ' '.join(part for part in (house.get('full_name'), apartment) if part)
+
+
+def build_customer_index(customer_data, houses_data):
+    """Resolve customer export fields once per customer
+
+    Returns:
+        dict: {"19448": {"customer_agreement": ..., "customer_name": ..., "customer_address": ...}}
+    """
+    return {
+        customer_id: {
+            'customer_agreement': (customer.get('agreement') or [{}])[0].get('number'),
+            'customer_name': customer.get('full_name'),
+            'customer_address': format_customer_address(customer, houses_data)
+        }
+        for customer_id, customer in customer_data.items()
+    }
+
+
+def commutation_key(customer_id, commutation):
+    """Stable row key: the commutation connect_id, or customer/object/interface if Userside did not send one"""
+    connect_id = commutation.get('connect_id')
+    if connect_id:
+        return str(connect_id)
+    return f"{customer_id}/{commutation.get('object_type')}/{commutation.get('object_id')}/{commutation.get('interface')}"
+
+
+def commutation_keys(commutation_data, object_types):
+    """Row keys of all commutations with the given object types, exported or not"""
+    return {
+        commutation_key(customer_id, commutation)
+        for customer_id, commutations in commutation_data.items()
+        if isinstance(commutations, list)
+        for commutation in commutations
+        if isinstance(commutation, dict) and commutation.get('object_type') in object_types
+    }
+
+
+def iter_export_rows(commutation_data, customer_index, resolvers):
+    """Join commutations with precomputed customer index and resolvers, yielding one export row at a time
+
+    Args:
+        commutation_data: get_commutation_data result
+        customer_index: build_customer_index result
+        resolvers: create_resolvers result
+    """
+    # Process each customer's commutation data
+    for customer_id, commutations in commutation_data.items():
+        customer_row = customer_index.get(customer_id)
+        if customer_row is None:
+            # Customer chunk failed after all retries, skip instead of failing the export
+            logger.warning(f"No customer data for object ID: {customer_id}, skipping")
+            continue
+
+        if not commutations or not isinstance(commutations[0], dict):
+            logger.warning(f"Unexpected commutation format: {commutations}")
+            continue
+
+        for commutation in commutations:
+            device_type = commutation.get('object_type')
+            resolver = resolvers.get(device_type)
+            if resolver is None:
+                continue
+
+            device_id = int(commutation.get('object_id') or 0)
+            device_row = resolver.resolve(device_id, commutation.get('interface'))
+            if device_row is None:
+                logger.warning(f"No data for {device_type} id: {device_id}, skipping")
+                continue
+
+            # Device Data to export, connect_id is not exported but keys the row for --since-last
+            yield {
+                'connect_id': commutation_key(customer_id, commutation),
+                **customer_row,
+                'device_type': device_type,
+                **device_row
+            }
+
+
+def build_export_frame(commutation_data, customer_index, resolvers):
+    """pandas variant of iter_export_rows: join commutations, customers and devices with DataFrame merges
+
+    Resolvers are called once per distinct (object type, object id, interface), not per row.
+    Produces the same rows in the same order as iter_export_rows.
+
+    Returns:
+        pandas.DataFrame: EXPORT_COLUMNS and connect_id columns, missing values as None
+    """
+    import pandas as pd
+
+    # Object columns, a missing interface must not turn the others into floats (14 -> '14.0')
+    # Interface numbers are matched as strings, like device interface keys
+    commutations = pd.DataFrame(
+        [
+            (
+                customer_id, commutation.get('object_type'), commutation.get('object_id'),
+                commutation.get('interface'), str(commutation.get('interface')),
+                commutation_key(customer_id, commutation)
+            )
+            for customer_id, customer_commutations in commutation_data.items()
+            if customer_commutations and isinstance(customer_commutations[0], dict)
+            for commutation in customer_commutations
+        ],
+        columns=['customer_id', 'device_type', 'device_id', 'interface', 'port', 'connect_id'],
+        dtype=object
+    )
+    commutations = commutations[commutations['device_type'].isin(list(resolvers))]
+    commutations = commutations.assign(
+        device_id=pd.to_numeric(commutations['device_id'], errors='coerce').fillna(0).astype('int64')
+    )
+
+    customers = pd.DataFrame({
+        'customer_id': list(customer_index),
+        **{
+            column: [row[column] for row in customer_index.values()]
+            for column in ('customer_agreement', 'customer_name', 'customer_address')
+        }
+    }, dtype=object)
+
+    device_keys = commutations[['device_type', 'device_id', 'interface', 'port']].drop_duplicates(
+        subset=['device_type', 'device_id', 'port']
+    )
+    device_rows = []
+    for device_type, device_id, interface, port in device_keys.itertuples(index=False, name=None):
+        device_row = resolvers[device_type].resolve(device_id, interface)
+        if device_row is not None:
+            device_rows.append({'device_type': device_type, 'device_id': device_id, 'port': port, **device_row})
+    devices = pd.DataFrame(
+        device_rows,
+        columns=['device_type', 'device_id', 'port', 'location', 'hostname', 'ip', 'name', 'iface_data']
+    ).astype({'device_id': 'int64'})
+
+    frame = (
+        commutations
+        .merge(customers, on='customer_id', how='inner')
+        .merge(devices, on=['device_type', 'device_id', 'port'], how='inner')
+    )
+    frame = frame[['connect_id', *EXPORT_COLUMNS]].astype(object)
+    return frame.where(frame.notna(), None)
+
+
+def iter_frame_rows(frame):
+    """Yield DataFrame rows as dicts, for export_rows"""
+    columns = list(frame.columns)
+    for values in frame.itertuples(index=False, name=None):
+        yield dict(zip(columns, values))
+
+
+def build_rows(engine, commutation_data, customer_index, resolvers):
+    """Export rows produced by the --engine join engine
+
+    Args:
+        customer_index: build_customer_index result
+    """
+    if engine == 'pandas':
+        return iter_frame_rows(build_export_frame(commutation_data, customer_index, resolvers))
+    return iter_export_rows(commutation_data, customer_index, resolvers)
+
+
+def transform_houses_data(houses_data):
+    """Transform houses data into simplified format"""
+    transformed_data = {}
+    for house_id, house_info in houses_data.items():
+        transformed_data[house_info.get('building_id')] = {
+            'house_id': house_id,
+            'full_name': house_info.get('full_name')
+        }
+    return transformed_data
+
+def customer_building_ids(customer_data):
+    """Ids of the houses customers are connected in"""
+    return [
+        customer.get('address')[0].get('house_id')
+        for customer in customer_data.values() if customer.get('address')
+    ]
+
+
+def import_legacy_device_cache(device_cache):
+    """Import devices_data.json of older versions into an empty devices cache"""
+    if device_cache.is_empty('switch') and os.path.exists(LEGACY_DEVICE_CACHE_FILE):
+        logger.info(f"Importing devices data from {LEGACY_DEVICE_CACHE_FILE}...")
+        with open(LEGACY_DEVICE_CACHE_FILE, 'r') as f:
+            device_cache.store(json.load(f).items(), fetched_at=os.path.getmtime(LEGACY_DEVICE_CACHE_FILE))
+
+
+class ExportScope:
+    """Part of the base to export: given customers, customers of houses or groups, commutations of devices or nodes
+
+    All given filters must match. Customer, house and group filters are passed to Userside
+    (customer/get_customers_id) so only the commutations and data of matching customers
+    are fetched; device and node filters prune the commutations right after they are fetched.
+    """
+
+    def __init__(self, building_ids=(), group_ids=(), device_ids=(), node_ids=(), customer_ids=()):
+        self.building_ids = {str(building_id) for building_id in building_ids}
+        self.group_ids = {str(group_id) for group_id in group_ids}
+        self.device_ids = {int(device_id) for device_id in device_ids}
+        self.node_ids = {int(node_id) for node_id in node_ids}
+        self.customer_ids = {str(customer_id) for customer_id in customer_ids}
+
+    def __bool__(self):
+        return bool(self.building_ids or self.group_ids or self.device_ids or self.node_ids or self.customer_ids)
+
+    def describe(self):
+        """Filters as a JSON serializable dict, e.g. to tell runs of different scopes apart"""
+        return {
+            name: sorted(str(value) for value in getattr(self, name))
+            for name in ('building_ids', 'group_ids', 'device_ids', 'node_ids', 'customer_ids')
+        }
+
+    def fetch_customer_ids(self, api):
+        """Ids of customers matching the customer, house and group filters
+
+        Returns:
+            list: customer ids, or None if there are no such filters or Userside could not apply them
+        """
+        if not self.building_ids and not self.group_ids:
+            return sorted(self.customer_ids, key=int) or None
+        customer_ids = api.get_customer_ids(sorted(self.building_ids), sorted(self.group_ids))
+        if customer_ids is None:
+            logger.warning("Failed to fetch customer ids of the export scope, filtering all customers locally")
+            return sorted(self.customer_ids, key=int) or None
+        if self.customer_ids:
+            customer_ids = [customer_id for customer_id in customer_ids if customer_id in self.customer_ids]
+        return customer_ids
+
+    def object_ids(self, api, device_cache):
+        """Ids of commutation objects matching the device and node filters
+
+        Nodes are looked up in the devices cache, which is filled first if it is empty.
+
+        Returns:
+            set: object ids, or None if there are no such filters
+        """
+        if not self.node_ids:
+            return self.select_objects(None)
+        if device_cache.is_empty('switch'):
+            device_cache.refresh(api, (), 'switch', full=True)
+        return self.select_objects(device_cache.node_device_ids(self.node_ids))
+
+    def select_objects(self, node_device_ids):
+        """Combine the device filter with the ids of the devices in the scope nodes
+
+        Returns:
+            set: object ids, or None if there are no device and node filters
+        """
+        if not self.node_ids:
+            return self.device_ids or None
+        return node_device_ids & self.device_ids if self.device_ids else node_device_ids
+
+    def filter_commutations(self, commutation_data, object_ids):
+        """Keep only commutations with the given devices and customers that have any of them
+
+        Only device-backed object types (see DeviceResolver) share the device id space;
+        cross boxes, splitters and fibers have ids of their own and never match.
+        """
+        device_types = {
+            object_type for object_type, resolver_class in RESOLVERS.items()
+            if issubclass(resolver_class, DeviceResolver)
+        }
+        scoped = {}
+        for customer_id, commutations in commutation_data.items():
+            if not isinstance(commutations, list):
+                continue
+            commutations = [
+                commutation for commutation in commutations
+                if isinstance(commutation, dict) and commutation.get('object_type') in device_types
+                and int(commutation.get('object_id') or 0) in object_ids
+            ]
+            if commutations:
+                scoped[customer_id] = commutations
+        return scoped
+
+    def filter_customers(self, customer_data):
+        """Customers matching the customer, house and group filters, in case Userside did not apply them"""
+        def matches(customer_id, customer):
+            if self.customer_ids and str(customer_id) not in self.customer_ids:
+                return False
+            if self.building_ids:
+                address = (customer.get('address') or [{}])[0]
+                if str(address.get('house_id')) not in self.building_ids:
+                    return False
+            if self.group_ids:
+                groups = customer.get('group') or {}
+                # Userside returns an empty list instead of an empty object
+                if not isinstance(groups, dict) or not self.group_ids & set(groups):
+                    return False
+            return True
+
+        return {
+            customer_id: customer for customer_id, customer in customer_data.items() if matches(customer_id, customer)
+        }
+
+
+def fetch_commutations(api, device_cache, scope=None):
+    """Fetch customer commutations, only of the customers and objects in scope if given"""
+    if not scope:
+        return api.get_commutation_data(objects_type='customer')
+
+    customer_ids = scope.fetch_customer_ids(api)
+    if customer_ids is None:
+        commutation_data = api.get_commutation_data(objects_type='customer')
+    else:
+        logger.info(f"Export scope: {len(customer_ids)} customers")
+        commutation_data = api.get_commutation_data('customer', object_ids=customer_ids)
+
+    object_ids = scope.object_ids(api, device_cache)
+    if commutation_data and object_ids is not None:
+        commutation_data = scope.filter_commutations(commutation_data, object_ids)
+        logger.info(f"Export scope: {len(commutation_data)} customers connected to {len(object_ids)} devices")
+    return commutation_data
+
+
+def scope_customers(scope, commutation_data, customer_data):
+    """Drop customers outside the scope, and their commutations
+
+    Returns:
+        tuple: (commutation_data, customer_data)
+    """
+    if not scope:
+        return commutation_data, customer_data
+    scoped = scope.filter_customers(customer_data)
+    removed = customer_data.keys() - scoped.keys()
+    if removed:
+        commutation_data = {
+            customer_id: commutations for customer_id, commutations in commutation_data.items()
+            if customer_id not in removed
+        }
+    return commutation_data, scoped
+
+
+def resolve_objects(api, device_cache, commutation_data, full=False, downloaded=()):
+    """create_resolvers for the objects of commutation_data, skipping the devices fetch completed before --resume"""
+    checkpoint = api.checkpoint
+    prefetch = checkpoint is None or not checkpoint.load('devices')
+    if not prefetch:
+        logger.info(f"Resuming: devices already fetched to {device_cache.path}")
+    resolvers = create_resolvers(
+        api, device_cache, referenced_objects(commutation_data), full=full, prefetch=prefetch, downloaded=downloaded
+    )
+    if checkpoint is not None:
+        checkpoint.save('devices', True)
+    return resolvers
+
+
+def fetch_export_data(api, customer_cache, house_cache, device_cache, full=False, scope=None):
+    """Fetch commutations, customers, houses and devices one after another
+
+    Completed stages are saved to and loaded from api.checkpoint, if set.
+    With an ExportScope only the customers and objects in scope are fetched.
+
+    Returns:
+        tuple: (commutation_data, customer_data, houses_data, resolvers), commutation_data is None on error
+    """
+    # Fetch commutation data
+    logger.info("Fetching commutation data...")
+    with api.stats.stage('commutations'):
+        commutation_data = checkpointed(
+            api.checkpoint, 'commutations', lambda: fetch_commutations(api, device_cache, scope)
+        )
+    if not commutation_data:
+        logger.warning("No commutation data found")
+        return None, {}, {}, {}
+
+    # Fetch customer data, only new and expired customers are requested from Userside
+    logger.info("Fetching customer data...")
+    with api.stats.stage('customers'):
+        customer_data = checkpointed(
+            api.checkpoint, 'customers',
+            lambda: customer_cache.fetch(commutation_data.keys(), api.get_customer_data, full=full)
+        )
+        commutation_data, customer_data = scope_customers(scope, commutation_data, customer_data)
+
+    # Fetch houses data
+    logger.info("Fetching houses data...")
+    with api.stats.stage('houses'):
+        houses_data = checkpointed(
+            api.checkpoint, 'houses',
+            lambda: house_cache.fetch(customer_building_ids(customer_data), api.get_houses_data, full=full)
+        )
+        houses_data = transform_houses_data(houses_data)
+
+    # Fetch data of every referenced object type in one pass per type,
+    # devices are refreshed only if missing or expired
+    logger.info("Checking devices cache...")
+    with api.stats.stage('devices'):
+        resolvers = resolve_objects(api, device_cache, commutation_data, full=full)
+    return commutation_data, customer_data, houses_data, resolvers
+
+
+async def fetch_export_data_async(api, customer_cache, house_cache, device_cache, full=False, scope=None):
+    """Pipelined variant of fetch_export_data
+
+    A full devices download starts right away, in a worker thread, while commutations
+    are fetched. Customer batches are fetched concurrently and the houses of each batch
+    are requested as soon as it arrives, so the run takes about as long as the slowest
+    chain of dependent requests instead of the sum of all of them. Commutations, devices
+    and every customer and house chunk are saved to and loaded from api.checkpoint, if set.
+    A scoped export resolves its scope before the devices download starts, as node
+    filters read the devices cache.
+
+    Returns:
+        tuple: (commutation_data, customer_data, houses_data, resolvers), commutation_data is None on error
+    """
+    async_api = AsyncUsersideAPI(api)
+    devices_task = None
+    checkpoint = api.checkpoint
+    try:
+        def download_devices():
+            devices_fetched = checkpoint is not None and checkpoint.load('devices')
+            if (full or device_cache.is_empty('switch')) and not devices_fetched:
+                logger.info("Fetching all devices data in background...")
+                return asyncio.create_task(asyncio.to_thread(device_cache.refresh, api, (), 'switch', True))
+            return None
+
+        if not scope:
+            devices_task = download_devices()
+
+        logger.info("Fetching commutation data...")
+        commutation_data = checkpoint.load('commutations') if checkpoint is not None else None
+        if commutation_data is None:
+            if scope:
+                commutation_data = await asyncio.to_thread(fetch_commutations, api, device_cache, scope)
+            else:
+                commutation_data = await async_api.get_commutation_data('customer')
+            if commutation_data and checkpoint is not None:
+                checkpoint.save('commutations', commutation_data)
+        if scope:
+            devices_task = download_devices()
+        if not commutation_data:
+            logger.warning("No commutation data found")
+            if devices_task:
+                await devices_task
+            return None, {}, {}, {}
+
+        async def resolve_devices():
+            # Fill in missing devices and other object types once the full download is done
+            downloaded = ()
+            if devices_task:
+                await devices_task
+                downloaded = ('switch',)
+            return await asyncio.to_thread(
+                resolve_objects, api, device_cache, commutation_data, full=full, downloaded=downloaded
+            )
+
+        resolvers_task = asyncio.create_task(resolve_devices())
+
+        async def fetch_houses(building_ids):
+            async for data in async_api.iter_chunks(async_api.get_houses_chunk, building_ids, 'house'):
+                house_cache.store(data.items())
+
+        customer_ids = [str(customer_id) for customer_id in commutation_data.keys()]
+        to_fetch = customer_ids if full else customer_cache.expired_ids(customer_ids)
+        logger.info(f"Fetching {len(to_fetch)} of {len(customer_ids)} customers from Userside API...")
+        requested_houses = set()
+        house_tasks = []
+
+        def request_houses(customers):
+            building_ids = {str(building_id) for building_id in customer_building_ids(customers)}
+            building_ids -= requested_houses
+            requested_houses.update(building_ids)
+            if not full:
+                building_ids = house_cache.expired_ids(sorted(building_ids))
+            if building_ids:
+                house_tasks.append(asyncio.create_task(fetch_houses(sorted(building_ids))))
+
+        async for data in async_api.iter_chunks(async_api.get_customer_chunk, to_fetch, 'customer'):
+            customer_cache.store(data.items())
+            request_houses(data)
+
+        customer_data = customer_cache.get_many(customer_ids)
+        commutation_data, customer_data = scope_customers(scope, commutation_data, customer_data)
+        # Houses of customers that were already cached
+        request_houses(customer_data)
+        await asyncio.gather(*house_tasks)
+        houses_data = transform_houses_data(house_cache.get_many(customer_building_ids(customer_data)))
+
+        resolvers = await resolvers_task
+        return commutation_data, customer_data, houses_data, resolvers
+    finally:
+        await async_api.close()
+
+
+def shard_commutations(commutation_data, shards):
+    """Split commutations into `shards` contiguous customer id ranges of about equal size"""
+    customer_ids = sorted(commutation_data, key=int)
+    size = max(-(-len(customer_ids) // shards), 1)
+    return [
+        {customer_id: commutation_data[customer_id] for customer_id in chunk}
+        for chunk in chunk_list(customer_ids, size)
+    ]
+
+
+def export_shard(shard, customer_index, export_format, filename, columns, engine, device_cache_path):
+    """Build and write the rows of one shard in a worker process
+
+    The worker gets the customer index rows of its shard, already resolved by the parent,
+    and reads devices from the SQLite device cache filled by the fetch stage.
+
+    Returns:
+        tuple: (number of rows, {"join": seconds, "write": seconds})
+    """
+    device_cache = DeviceCache(device_cache_path)
+    try:
+        resolvers = create_resolvers(None, device_cache, referenced_objects(shard), prefetch=False)
+        rows = build_rows(engine, shard, customer_index, resolvers)
+        stats = RunStats()
+        count = export_rows(rows, export_format, filename, stats=stats, columns=columns)
+        return count, stats.stages
+    finally:
+        device_cache.close()
+
+
+def export_shards(shards, customer_index, export_format, filenames, engine, device_cache_path,
+                  columns=EXPORT_COLUMNS, stats=None):
+    """Build and write shards in parallel, one process and one file per shard
+
+    Each worker is sent only the customer_index rows of its own shard.
+    Shards without rows do not produce a file.
+
+    Returns:
+        int: number of exported rows
+    """
+    total = 0
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [
+            executor.submit(
+                export_shard, shard,
+                {customer_id: customer_index[customer_id] for customer_id in shard if customer_id in customer_index},
+                export_format, filename, columns, engine, device_cache_path
+            )
+            for shard, filename in zip(shards, filenames)
+        ]
+        for future in futures:
+            count, stages = future.result()
+            total += count
+            if stats is not None:
+                # CPU time summed over the workers
+                stats.add_time('shard_join', stages.get('join', 0.0))
+                stats.add_time('shard_write', stages.get('write', 0.0))
+    return total
+
+
+def concat_shard_files(filenames, filename, export_format):
+    """Concatenate csv or jsonl shard files into one export, keeping only the first CSV header
+
+    Written to a temporary file renamed once complete, like export_rows.
+    """
+    tmp_filename = f"{filename}.tmp"
+    header_written = False
+    try:
+        with open(tmp_filename, 'wb') as out:
+            for part in filenames:
+                if not os.path.exists(part):
+                    continue
+                with open(part, 'rb') as f:
+                    if export_format == 'csv':
+                        header = f.readline()
+                        if not header_written:
+                            out.write(header)
+                            header_written = True
+                    shutil.copyfileobj(f, out, 1 << 20)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+
+def iter_shard_rows(filenames):
+    """Rows of JSON lines shard files, in shard order"""
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def partition_filenames(filename, count):
+    """commutation.csv -> commutation.part-000.csv, commutation.part-001.csv, ..."""
+    stem, extension = os.path.splitext(filename)
+    return [f"{stem}.part-{index:03d}{extension}" for index in range(count)]
+
+
+# Content types of export formats served by ExportService
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+
+class ServiceSnapshot:
+    """Export data of one ExportService refresh, replaced as a whole by the next one"""
+
+    def __init__(self, commutation_data, customer_data, houses_data, resolvers, node_devices, report):
+        self.commutation_data = commutation_data
+        self.customer_data = customer_data
+        self.customer_index = build_customer_index(customer_data, houses_data)
+        self.resolvers = resolvers
+        self.node_devices = node_devices
+        self.agreements = {
+            row['customer_agreement']: customer_id for customer_id, row in self.customer_index.items()
+            if row['customer_agreement']
+        }
+        self.refreshed_at = time.time()
+        self.report = report
+
+    def rows(self, scope=None):
+        """Export rows of the whole base or of an ExportScope"""
+        commutation_data = self.commutation_data
+        if scope:
+            object_ids = scope.select_objects(
+                set().union(*(self.node_devices.get(node_id, ()) for node_id in scope.node_ids))
+            )
+            if object_ids is not None:
+                commutation_data = scope.filter_commutations(commutation_data, object_ids)
+            if scope.building_ids or scope.group_ids or scope.customer_ids:
+                customers = scope.filter_customers(
+                    {customer_id: self.customer_data.get(customer_id) or {} for customer_id in commutation_data}
+                )
+                commutation_data = {customer_id: commutation_data[customer_id] for customer_id in customers}
+        return iter_export_rows(commutation_data, self.customer_index, self.resolvers)
+
+    def customer_rows(self, customer_id):
+        """Export rows of one customer, None if the customer has no commutations"""
+        commutations = self.commutation_data.get(str(customer_id))
+        if commutations is None:
+            return None
+        return list(iter_export_rows({str(customer_id): commutations}, self.customer_index, self.resolvers))
+
+
+class ExportService:
+    """Long-running export service keeping Userside sessions and export data warm in memory
+
+    Data is refreshed from Userside (through the local caches) every `refresh_interval`
+    seconds in a background thread. Requests are answered from the current snapshot,
+    which a refresh replaces only once it has completed.
+    """
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval or float(os.getenv('SERVICE_REFRESH_INTERVAL', 3600))
+        self.api = UsersideAPI()
+        self.customer_cache, self.house_cache, self.device_cache = open_caches()
+        self.snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_requested = threading.Event()
+        self._stopped = threading.Event()
+
+    def refresh(self):
+        """Fetch new and expired data and replace the snapshot, keeping the old one on errors"""
+        with self._refresh_lock:
+            stats = RunStats()
+            self.api.stats = stats
+            try:
+                with stats.stage('fetch'):
+                    commutation_data, customer_data, houses_data, resolvers = fetch_export_data(
+                        self.api, self.customer_cache, self.house_cache, self.device_cache
+                    )
+                if not commutation_data:
+                    logger.error("Failed to fetch commutation data from Userside API, keeping previous data")
+                    return False
+                with stats.stage('index'):
+                    snapshot = ServiceSnapshot(
+                        commutation_data, customer_data, houses_data, resolvers,
+                        self.device_cache.node_index(), stats.report()
+                    )
+            except Exception as e:
+                logger.exception(f"Refresh failed, keeping previous data: {e}")
+                return False
+            self.snapshot = snapshot
+            logger.info(f"Refreshed {len(commutation_data)} customers in {time.time() - stats.started_at:.1f}s")
+            return True
+
+    def request_refresh(self):
+        self._refresh_requested.set()
+
+    def _refresh_loop(self):
+        while not self._stopped.is_set():
+            self._refresh_requested.wait(self.refresh_interval)
+            self._refresh_requested.clear()
+            if not self._stopped.is_set():
+                self.refresh()
+
+    def serve(self, host='127.0.0.1', port=8080):
+        """Load the data, then serve requests until interrupted"""
+        self.refresh()
+        threading.Thread(target=self._refresh_loop, name='refresh', daemon=True).start()
+        server = ThreadingHTTPServer((host, port), ExportRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        logger.info(f"Serving exports on http://{host}:{port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            self._refresh_requested.set()
+            server.server_close()
+            self.api.close()
+
+    def status(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {'ready': False}
+        return {
+            'ready': True,
+            'refreshed_at': datetime.fromtimestamp(snapshot.refreshed_at).isoformat(timespec='seconds'),
+            'customers': len(snapshot.commutation_data),
+            'refreshing': self._refresh_lock.locked(),
+            'last_refresh': snapshot.report
+        }
+
+
+class ExportRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of ExportService
+
+    GET  /status                       snapshot age, size and the report of the last refresh
+    GET  /export?format=csv&node_ids=12 full or scoped export, scope parameters as on the command line
+    GET  /customer/<id>[?format=csv]   export rows of one customer
+    GET  /customer?agreement=<number>  export rows of the customer with an agreement number
+    POST /refresh                      refresh the data now
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path == '/refresh':
+            self.server.service.request_refresh()
+            self._send(202, {'refresh': 'scheduled'})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == '/status':
+            return self._send(200, service.status())
+
+        snapshot = service.snapshot
+        if snapshot is None:
+            return self._send(503, {'error': 'data is not loaded yet'})
+        export_format = query.get('format', 'json' if url.path.startswith('/customer') else 'csv')
+        try:
+            if url.path == '/export':
+                scope = ExportScope(*(id_list(query.get(name, '')) for name in (
+                    'building_ids', 'group_ids', 'device_ids', 'node_ids', 'customer_ids'
+                )))
+                return self._send_rows(snapshot.rows(scope), export_format)
+            if url.path == '/customer' or url.path.startswith('/customer/'):
+                customer_id = url.path[len('/customer/'):] or snapshot.agreements.get(query.get('agreement'))
+                rows = snapshot.customer_rows(customer_id) if customer_id else None
+                if rows is None:
+                    return self._send(404, {'error': 'customer not found'})
+                if export_format == 'json':
+                    return self._send(200, {'customer_id': customer_id, 'rows': rows})
+                return self._send_rows(rows, export_format)
+        except (argparse.ArgumentTypeError, ValueError) as e:
+            return self._send(400, {'error': str(e)})
+        self._send(404, {'error': 'not found'})
+
+    def _send_rows(self, rows, export_format):
+        """Write rows with the export format sink to a temporary file and send it"""
+        if export_format not in SINKS:
+            raise ValueError(f"unsupported format {export_format}, expected one of {', '.join(sorted(SINKS))}")
+        fd, filename = tempfile.mkstemp(suffix=f'.{export_format}')
+        os.close(fd)
+        try:
+            export_rows(rows, export_format, filename)
+            if not os.path.exists(filename):
+                # export_rows removes empty exports
+                return self._send(204, b'', CONTENT_TYPES[export_format])
+            with open(filename, 'rb') as f:
+                self._send(200, f.read(), CONTENT_TYPES[export_format])
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def id_list(value):
+    """argparse type for comma separated ids"""
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma separated ids, got {value!r}")
+
+
+# Subcommands, an export runs when none is given
+COMMANDS = ('export', 'refresh-cache', 'lookup', 'serve')
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # `export_commutation.py [options]` runs an export, as before subcommands were added
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ('-h', '--help')):
+        argv = ['export', *argv]
+
+    def logging_options(default='INFO'):
+        # Parent actions are shared between subcommands, so each gets its own
+        options = argparse.ArgumentParser(add_help=False)
+        options.add_argument(
+            '--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default=default,
+            help=f'logging level (default: {default})'
+        )
+        return options
+
+    reporting = argparse.ArgumentParser(add_help=False)
+    reporting.add_argument('--report', help='write a JSON run report with timings, counters and memory usage')
+    reporting.add_argument('--prometheus', help='write the run report in Prometheus text format')
+    fetching = argparse.ArgumentParser(add_help=False)
+    fetching.add_argument(
+        '--full-sync', action='store_true',
+        help='ignore cached customers, houses and devices and download everything again'
+    )
+    fetching.add_argument(
+        '--async', dest='async_fetch', action='store_true',
+        help='fetch data with the pipelined async client, requires httpx'
+    )
+
+    parser = argparse.ArgumentParser(description='Export commutation data from Userside')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    parser_export = commands.add_parser(
+        'export', parents=[logging_options(), fetching, reporting], help='export commutations to a file (default)'
+    )
+    parser_export.set_defaults(handler=run_export)
+    parser_export.add_argument(
+        '--format', choices=sorted(SINKS), default='xlsx',
+        help='export file format (default: xlsx, parquet requires pyarrow)'
+    )
+    parser_export.add_argument(
+        '--output', help='export file name (default: commutation_export_<timestamp>.<format>)'
+    )
+    parser_export.add_argument(
+        '--engine', choices=('loop', 'pandas'), default='loop',
+        help='join engine: row by row Python loop or pandas merges, same output (default: loop)'
+    )
+    parser_export.add_argument(
+        '--since-last', action='store_true',
+        help='export only rows added, changed or removed since the last --since-last run, with a change_type column'
+    )
+    scope = parser_export.add_argument_group(
+        'export scope', 'export only part of the base, all given filters must match'
+    )
+    scope.add_argument('--customer-ids', type=id_list, default=[], help='these customers')
+    scope.add_argument('--building-ids', type=id_list, default=[], help='customers connected in these houses')
+    scope.add_argument('--group-ids', type=id_list, default=[], help='customers of these customer groups')
+    scope.add_argument('--device-ids', type=id_list, default=[], help='commutations with these devices')
+    scope.add_argument('--node-ids', type=id_list, default=[], help='commutations with devices in these nodes')
+    parser_export.add_argument(
+        '--resume', action='store_true',
+        help='continue an interrupted run, reusing the stages and chunks it already fetched'
+    )
+    parser_export.add_argument(
+        '--work-dir', default=WORK_DIR,
+        help=f'directory keeping fetched stages and chunks until the export succeeds (default: {WORK_DIR})'
+    )
+    parser_export.add_argument(
+        '--workers', type=int, default=1,
+        help='build rows in this many processes, each taking a range of customer ids (default: 1)'
+    )
+    parser_export.add_argument(
+        '--partitions', action='store_true',
+        help='with --workers, write one file per worker instead of merging them into one'
+    )
+
+    parser_refresh = commands.add_parser(
+        'refresh-cache', parents=[logging_options(), fetching, reporting],
+        help='fetch new and expired customers, houses and devices into the local caches without exporting'
+    )
+    parser_refresh.set_defaults(handler=run_refresh_cache)
+
+    parser_lookup = commands.add_parser(
+        'lookup', parents=[logging_options('WARNING')], help='print the export rows of customers, e.g. the switch ports they are on'
+    )
+    parser_lookup.set_defaults(handler=run_lookup)
+    parser_lookup.add_argument('customer_ids', type=int, nargs='+', metavar='CUSTOMER_ID')
+    parser_lookup.add_argument(
+        '--format', choices=('jsonl', 'csv'), default='jsonl', help='output format (default: jsonl)'
+    )
+
+    parser_serve = commands.add_parser(
+        'serve', parents=[logging_options()], help='keep data in memory and serve exports and lookups over HTTP'
+    )
+    parser_serve.set_defaults(handler=run_serve)
+    parser_serve.add_argument(
+        'address', nargs='?', default='127.0.0.1:8080', metavar='[HOST:]PORT',
+        help='address to listen on (default: 127.0.0.1:8080)'
+    )
+    parser_serve.add_argument(
+        '--refresh-interval', type=float,
+        help='seconds between data refreshes (default: SERVICE_REFRESH_INTERVAL or 3600)'
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        if args.partitions and args.since_last:
+            parser_export.error('--partitions cannot be combined with --since-last')
+        args.scope = ExportScope(
+            args.building_ids, args.group_ids, args.device_ids, args.node_ids, args.customer_ids
+        )
+        if args.scope and args.since_last:
+            parser_export.error('--since-last compares full exports and cannot be combined with scope options')
+    return args
+
+
+def open_caches():
+    """Open the customers, houses and devices caches
+
+    Returns:
+        tuple: (customer_cache, house_cache, device_cache)
+    """
+    customer_cache = RecordCache('customers', max_age=float(os.getenv('CUSTOMER_CACHE_MAX_AGE', 86400)))
+    house_cache = RecordCache(
+        'houses', max_age=float(os.getenv('HOUSE_CACHE_MAX_AGE', 7 * 86400)), key_field='building_id'
+    )
+    device_cache = DeviceCache()
+    import_legacy_device_cache(device_cache)
+    return customer_cache, house_cache, device_cache
+
+
+def fetch_with(args, api, caches, scope=None):
+    """fetch_export_data, or its async variant with --async"""
+    if args.async_fetch:
+        return asyncio.run(fetch_export_data_async(api, *caches, full=args.full_sync, scope=scope))
+    return fetch_export_data(api, *caches, full=args.full_sync, scope=scope)
+
+
+def write_reports(args, stats):
+    stats.log_summary()
+    if args.report:
+        stats.write_json(args.report)
+    if args.prometheus:
+        stats.write_prometheus(args.prometheus)
+
+
+def run_export(args):
+    stats = RunStats()
+    checkpoint = None
+
+    try:
+        # Initialize API client, fetched data is checkpointed until the export is written
+        checkpoint = Checkpoint(args.work_dir, resume=args.resume, params={
+            'scope': args.scope.describe(), 'full_sync': args.full_sync, 'async': args.async_fetch
+        })
+        api = UsersideAPI(stats=stats, checkpoint=checkpoint)
+        customer_cache, house_cache, device_cache = caches = open_caches()
+
+        with stats.stage('fetch'):
+            commutation_data, customer_data, houses_data, resolvers = fetch_with(args, api, caches, args.scope)
+        
+        if commutation_data and args.since_last and stats.counters.get('failed_chunks'):
+            # Rows built from partial data would show up as changed or removed, and be diffed
+            # against next time; keep the last complete state and the fetched chunks instead
+            logger.error(f"{stats.counters['failed_chunks']} chunks failed to fetch, not exporting changes. "
+                         f"Run again with --resume to fetch only the failed chunks")
+
+        elif commutation_data:
+            with stats.stage('index'):
+                customer_index = build_customer_index(customer_data, houses_data)
+            filename = args.output or default_filename(args.format)
+            if args.workers > 1:
+                logger.info(f"Processing commutation data in {args.workers} processes...")
+                shards = shard_commutations(commutation_data, args.workers)
+
+            if args.workers > 1 and args.partitions:
+                with stats.stage('shards'):
+                    count = export_shards(
+                        shards, customer_index, args.format, partition_filenames(filename, len(shards)),
+                        args.engine, device_cache.path, stats=stats
+                    )
+                stats.count('rows', count)
+                logger.info(f"{count} rows exported to {len(shards)} partitions of {filename}")
+
+            elif args.workers > 1 and not args.since_last and args.format in ('csv', 'jsonl'):
+                # Text shard files are concatenated as written, rows are not parsed again
+                shard_files = [
+                    os.path.join(checkpoint.work_dir, f"shard-{index:03d}.{args.format}")
+                    for index in range(len(shards))
+                ]
+                with stats.stage('shards'):
+                    count = export_shards(
+                        shards, customer_index, args.format, shard_files, args.engine, device_cache.path, stats=stats
+                    )
+                stats.count('rows', count)
+                if count:
+                    with stats.stage('merge'):
+                        concat_shard_files(shard_files, filename, args.format)
+                    logger.info(f"Data exported successfully to {filename}")
+                else:
+                    logger.warning("No data to export")
+
+            else:
+                if args.workers > 1:
+                    # Workers write JSON lines shard files to the work directory, merged below in customer id order
+                    shard_files = [
+                        os.path.join(checkpoint.work_dir, f"shard-{index:03d}.jsonl") for index in range(len(shards))
+                    ]
+                    with stats.stage('shards'):
+                        export_shards(
+                            shards, customer_index, 'jsonl', shard_files, args.engine, device_cache.path,
+                            columns=SHARD_COLUMNS, stats=stats
+                        )
+                    rows = iter_shard_rows(shard_files)
+                else:
+                    logger.info("Processing commutation data...")
+                    with stats.stage('index'):
+                        rows = build_rows(args.engine, commutation_data, customer_index, resolvers)
+                if args.since_last:
+                    export_state = ExportState()
+                    current_ids = commutation_keys(commutation_data, resolvers)
+                    export_rows(
+                        export_state.diff(rows, current_ids), args.format, filename, stats=stats, columns=DIFF_COLUMNS
+                    )
+                    stats.count('unresolved_rows', export_state.unresolved)
+                    if export_state.unresolved:
+                        logger.warning(f"{export_state.unresolved} rows could not be resolved, kept as last exported")
+                    export_state.commit()
+                    export_state.close()
+                else:
+                    export_rows(rows, args.format, filename, stats=stats)
+            checkpoint.clear()
+            
+        else:
+            logger.error("Failed to fetch commutation data from Userside API")
+            
+    except Exception as e:
+        logger.exception(f"An error occurred: {e}")
+        if checkpoint is not None:
+            logger.error(f"Fetched data is kept in {checkpoint.work_dir}, run again with --resume to continue")
+
+    finally:
+        write_reports(args, stats)
+
+
+def run_refresh_cache(args):
+    stats = RunStats()
+    try:
+        api = UsersideAPI(stats=stats)
+        with stats.stage('fetch'):
+            commutation_data, customer_data, houses_data, resolvers = fetch_with(args, api, open_caches())
+        if commutation_data:
+            logger.info(f"Caches refreshed: {len(customer_data)} customers, {len(houses_data)} houses, "
+                        f"{len(resolvers)} object types")
+        else:
+            logger.error("Failed to fetch commutation data from Userside API")
+    except Exception as e:
+        logger.exception(f"An error occurred: {e}")
+    finally:
+        write_reports(args, stats)
+
+
+def run_lookup(args):
+    api = UsersideAPI()
+    scope = ExportScope(customer_ids=args.customer_ids)
+    commutation_data, customer_data, houses_data, resolvers = fetch_export_data(api, *open_caches(), scope=scope)
+    if not commutation_data:
+        logger.error(f"No commutations found for customers {list_to_string(args.customer_ids)}")
+        return
+    rows = build_rows('loop', commutation_data, build_customer_index(customer_data, houses_data), resolvers)
+    if args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=EXPORT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            print(json.dumps({column: row.get(column) for column in EXPORT_COLUMNS}, ensure_ascii=False, default=str))
+
+
+def run_serve(args):
+    host, _, port = args.address.rpartition(':')
+    ExportService(args.refresh_interval).serve(host or '127.0.0.1', int(port))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    # httpx logs every request at INFO level
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    args.handler(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()